@@ -0,0 +1,108 @@
+"""Cold-start import time of the plugin process, checked against a regression budget
+
+Imports main.py (which loads the provider and every tool, as the plugin
+runtime does on start) in fresh interpreters and reports the median wall
+time, the time on top of importing dify_plugin alone, the slowest imports
+from -X importtime, and which heavy SDKs ended up loaded. The SDKs should
+only be imported when a tool first needs them, so any of them loaded by our
+code (rather than by dify_plugin itself) counts as a regression, as does a
+median above the budget.
+
+    python benchmarks/cold_start.py --runs 10 --budget-ms 300
+    python benchmarks/cold_start.py --target modules   # provider + tools without constructing Plugin
+
+Exits with status 1 when the budget is exceeded.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PLUGIN_DIR = os.path.join(ROOT, "txt2img")
+
+# 插件代码在 dify_plugin 之外额外增加的导入耗时上限 (毫秒)
+COLD_START_BUDGET_MS = float(os.environ.get("TXT2IMG_COLD_START_BUDGET_MS") or 300)
+# 只应在首次使用时导入的 SDK
+HEAVY_MODULES = ["openai", "tos", "requests", "httpx"]
+TARGETS = {
+    "main": "import main",
+    "modules": "import provider.txt2img, tools.flux, tools.dalle3, tools.recraftv3, tools.seededit, tools.s3edit",
+    "baseline": "import dify_plugin",
+}
+
+CHILD = """
+import sys, time, json
+start = time.perf_counter()
+{statement}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"ms": elapsed * 1000, "heavy": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def measure(statement: str, importtime: bool = False) -> tuple[dict, str]:
+    command = [sys.executable, *(["-X", "importtime"] if importtime else []), "-c", CHILD.format(statement=statement, heavy=HEAVY_MODULES)]
+    output = subprocess.run(command, cwd=PLUGIN_DIR, stdin=subprocess.DEVNULL, capture_output=True, text=True)
+    if output.returncode != 0:
+        raise SystemExit(f"Import failed:\n{output.stderr.strip()[-2000:]}")
+    return json.loads(output.stdout.strip().splitlines()[-1]), output.stderr
+
+
+def slowest_imports(importtime_log: str, top: int) -> list[tuple[int, str]]:
+    """Top-level packages by cumulative import time (microseconds) from -X importtime output"""
+    totals: dict[str, int] = {}
+    for line in importtime_log.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        try:
+            _, cumulative, name = (part.strip() for part in line[len("import time:") :].split("|"))
+            cumulative_us = int(cumulative)
+        except ValueError:
+            continue
+        package = name.strip().split(".")[0]
+        # 同一个顶层包取其最大的累计值, 即包本身的导入耗时
+        totals[package] = max(totals.get(package, 0), cumulative_us)
+    return sorted(((us, name) for name, us in totals.items()), reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--target", choices=["main", "modules"], default="main")
+    parser.add_argument("--runs", type=int, default=7)
+    parser.add_argument("--budget-ms", type=float, default=COLD_START_BUDGET_MS, help="allowed import time on top of dify_plugin")
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    baseline = [measure(TARGETS["baseline"])[0] for _ in range(args.runs)]
+    target = [measure(TARGETS[args.target])[0] for _ in range(args.runs)]
+    baseline_ms = statistics.median(r["ms"] for r in baseline)
+    target_ms = statistics.median(r["ms"] for r in target)
+    own_ms = target_ms - baseline_ms
+    added_heavy = sorted(set(target[-1]["heavy"]) - set(baseline[-1]["heavy"]))
+
+    print(f"import dify_plugin        median {baseline_ms:8.1f} ms  (runs={args.runs})")
+    print(f"import {args.target:<18} median {target_ms:8.1f} ms")
+    print(f"plugin code on top        median {own_ms:8.1f} ms  budget {args.budget_ms:.0f} ms")
+    print(f"heavy SDKs loaded by dify_plugin: {', '.join(baseline[-1]['heavy']) or 'none'}")
+    print(f"heavy SDKs loaded by plugin code: {', '.join(added_heavy) or 'none'}")
+
+    _, log = measure(TARGETS[args.target], importtime=True)
+    print("slowest top-level imports (cumulative):")
+    for us, name in slowest_imports(log, args.top):
+        print(f"    {us / 1000:8.1f} ms  {name}")
+
+    failures = []
+    if own_ms > args.budget_ms:
+        failures.append(f"cold start {own_ms:.1f} ms exceeds budget {args.budget_ms:.0f} ms")
+    if added_heavy:
+        failures.append(f"heavy SDKs imported at startup: {', '.join(added_heavy)}")
+    for failure in failures:
+        print(f"REGRESSION: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
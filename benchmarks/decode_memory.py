@@ -0,0 +1,141 @@
+"""Peak-memory benchmark for decoding b64_json image responses
+
+Runs the legacy split-and-decode path and ImageGenerator.process_response in
+separate child processes and reports peak RSS per invocation, plus how many
+concurrent invocations fit in the plugin memory limit from manifest.yaml.
+
+    python benchmarks/decode_memory.py --images 4 --image-mb 6
+"""
+
+import argparse
+import base64
+import ctypes
+import json
+import os
+import resource
+import subprocess
+import sys
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "txt2img"))
+
+PLUGIN_MEMORY_LIMIT = 268435456  # manifest.yaml resource.memory
+
+
+def legacy_decode(base64_image: str) -> tuple[str, bytes]:
+    if not base64_image.startswith("data:image"):
+        return ("image/png", base64.b64decode(base64_image))
+    mime_type = base64_image.split(";")[0].split(":")[1]
+    image_data = base64.b64decode(base64_image.split(",")[1])
+    return (mime_type, image_data)
+
+
+def legacy_process(response):
+    for image in response["data"]:
+        b64_json = image.get("b64_json")
+        if not b64_json:
+            continue
+        yield legacy_decode(b64_json)
+
+
+def build_response(images: int, image_bytes: int) -> dict:
+    data = []
+    for _ in range(images):
+        payload = base64.b64encode(os.urandom(image_bytes)).decode()
+        data.append({"b64_json": f"data:image/png;base64,{payload}"})
+    return {"data": data}
+
+
+def peak_rss() -> int:
+    """Peak resident set size of this process in bytes"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def reset_peak_rss() -> None:
+    """Reset the kernel's RSS high-water mark so setup allocations are not counted (Linux only)"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def release_free_heap() -> bool:
+    """Hand memory freed while building the response back to the OS (glibc only)
+
+    Otherwise decoding reuses those already-resident pages and the RSS
+    high-water mark never moves; returns False when that is not possible.
+    """
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        return False
+    return True
+
+
+def run_child(mode: str, images: int, image_bytes: int) -> None:
+    from tools.base_image_tool import ImageGenerator
+
+    response = build_response(images, image_bytes)
+    trimmed = release_free_heap()
+    reset_peak_rss()
+    baseline_rss = peak_rss()
+    process = legacy_process if mode == "legacy" else ImageGenerator.process_response
+
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    start_current, _ = tracemalloc.get_traced_memory()
+    total = 0
+    # 模拟工具逐个 yield blob 给 daemon 后即释放
+    for _, blob in process(response):
+        total += len(blob)
+        del blob
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # 无法归还空闲堆时 RSS 峰值不会变化, 不报告一个误导性的 0
+    rss_growth = max(peak_rss() - baseline_rss, 0) if trimmed else None
+    print(json.dumps({"mode": mode, "decoded_bytes": total, "traced_peak": peak - start_current, "rss_growth": rss_growth}))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--images", type=int, default=4, help="images per response (n)")
+    parser.add_argument("--image-mb", type=float, default=6.0, help="decoded size of each image in MB")
+    parser.add_argument("--child", choices=["legacy", "streaming"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    image_bytes = int(args.image_mb * 1024 * 1024)
+
+    if args.child:
+        run_child(args.child, args.images, image_bytes)
+        return
+
+    response_bytes = sum(len(i["b64_json"]) for i in build_response(1, image_bytes)["data"]) * args.images
+    print(f"response: {args.images} x {args.image_mb} MB images, {response_bytes / 2**20:.1f} MB of base64 text")
+    print(f"{'mode':<10} {'traced peak':>12} {'rss growth':>12} {'fits in 256MB':>14}")
+    for mode in ("legacy", "streaming"):
+        out = subprocess.run(
+            [sys.executable, __file__, "--child", mode, "--images", str(args.images), "--image-mb", str(args.image_mb)],
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+        result = json.loads(out.stdout.strip().splitlines()[-1])
+        # 每个并发调用都要持有完整响应文本加上解码期间的峰值
+        rss_growth = result["rss_growth"]
+        per_invocation = response_bytes + max(rss_growth or 0, result["traced_peak"])
+        fits = PLUGIN_MEMORY_LIMIT // per_invocation
+        rss_column = f"{rss_growth / 2**20:>10.1f}MB" if rss_growth is not None else f"{'n/a':>12}"
+        print(f"{mode:<10} {result['traced_peak'] / 2**20:>10.1f}MB {rss_column} {fits:>14d}")
+
+
+if __name__ == "__main__":
+    main()
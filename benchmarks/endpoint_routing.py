@@ -0,0 +1,116 @@
+"""Exercise EndpointRouter against local stub OpenAI-compatible servers
+
+Starts one stub server per endpoint, each with its own latency and failure
+rate, sends requests through the router from several client threads and
+prints where the traffic went. Halfway through, the fastest server starts
+failing every request. It should be ejected within a few requests, and
+traffic should come back to it once it recovers.
+
+    python benchmarks/endpoint_routing.py --requests 400 --threads 8
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "txt2img"))
+
+from tools import endpoint_router  # noqa: E402
+from tools.endpoint_router import EndpointRouter  # noqa: E402
+
+
+class StubServer:
+    """Answers POST /v1/chat/completions after `latency` seconds, or 503 while failing"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.failing = False
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                time.sleep(stub.latency)
+                if stub.failing:
+                    self.send_response(503)
+                    self.end_headers()
+                    return
+                body = json.dumps({"choices": [{"message": {"content": "ok"}}]}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+
+class StatusError(Exception):
+    def __init__(self, status_code: int):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+
+def send(router: EndpointRouter) -> str:
+    endpoint = router.choose()
+    request = urllib.request.Request(endpoint.url("v1/chat/completions"), data=b"{}", method="POST")
+    try:
+        with router.track(endpoint):
+            try:
+                with urllib.request.urlopen(request, timeout=10) as response:
+                    response.read()
+            except urllib.error.HTTPError as e:
+                raise StatusError(e.code) from e
+    except StatusError:
+        return endpoint.base_url + " (failed)"
+    return endpoint.base_url
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--eject-seconds", type=float, default=1.0)
+    args = parser.parse_args()
+
+    # 缩短摘除时间, 让恢复过程在一次运行内可见
+    endpoint_router.EJECT_SECONDS = args.eject_seconds
+    servers = {"fast": StubServer(0.01), "medium": StubServer(0.03), "slow": StubServer(0.08)}
+    names = {s.base_url: name for name, s in servers.items()}
+    router = EndpointRouter([(s.base_url, 1.0) for s in servers.values()])
+
+    def phase(label: str, count: int):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.threads) as pool:
+            results = list(pool.map(lambda _: send(router), range(count)))
+        elapsed = time.perf_counter() - start
+        counts = Counter(names.get(r.split(" ")[0], r) + (" (failed)" if r.endswith("(failed)") else "") for r in results)
+        print(f"{label:<22} {elapsed:6.2f}s  {dict(sorted(counts.items()))}")
+        for snapshot in router.snapshot():
+            print(f"    {names[snapshot['base_url']]:<7} latency={snapshot['latency_ms']}ms error_rate={snapshot['error_rate']} ejected={snapshot['ejected']}")
+
+    quarter = max(args.requests // 4, 1)
+    phase("healthy", quarter)
+    servers["fast"].failing = True
+    phase("fast endpoint failing", quarter)
+    servers["fast"].failing = False
+    time.sleep(args.eject_seconds * 2.5)
+    phase("fast recovered", quarter)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Prompt size of the s3edit history context as a conversation grows
+
+Simulates an editing session where every turn stores an instruction, the
+ingested image URLs and a streamed response with a markdown image link, and
+compares the history part of the analysis prompt built the legacy way (every
+earlier entry, response text included) with HistoryContext.
+
+    python benchmarks/history_context.py --turns 200 --response-chars 1500
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "txt2img"))
+
+from tools.history_context import HistoryContext  # noqa: E402
+
+
+class MemoryStorage:
+    def __init__(self):
+        self.data = {}
+        self.writes = 0
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value):
+        self.writes += 1
+        self.data[key] = value
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+
+def make_entry(turn: int, response_chars: int) -> dict:
+    image = f"https://bucket.tos-cn-beijing.volces.com/s3edit/{turn:064x}.png"
+    progress = "".join(f"> 进度 {p}%\n" for p in range(0, 100, 5))
+    filler = ("生成完成，以下是根据你的描述调整后的图片。" * (response_chars // 20 + 1))[:response_chars]
+    return {
+        "dialogue_count": turn,
+        "instruction": f"第 {turn} 轮: 把背景换成黄昏的海边, 人物保持不变, 增加一些暖色调的光晕效果",
+        "image_urls": [f"https://bucket.tos-cn-beijing.volces.com/s3edit/{turn - 1:064x}.png"] if turn else [],
+        "response_content": f"{progress}{filler}\n![image]({image})",
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--response-chars", type=int, default=1500)
+    args = parser.parse_args()
+
+    storage = MemoryStorage()
+    history: list[dict] = []
+    checkpoints = {t for t in (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000) if t <= args.turns} | {args.turns}
+    print(f"{'turn':>6} {'legacy chars':>13} {'context chars':>14} {'build ms':>9} {'summary writes':>15}")
+    for turn in range(1, args.turns + 1):
+        history.append(make_entry(turn - 1, args.response_chars))
+        context = HistoryContext(storage, "s3edit_history_bench")
+        start = time.perf_counter()
+        built = context.build(history)
+        elapsed = (time.perf_counter() - start) * 1000
+        if turn in checkpoints:
+            legacy_chars = len(json.dumps(history, ensure_ascii=False))
+            context_chars = len(json.dumps(built, ensure_ascii=False))
+            print(f"{turn:>6} {legacy_chars:>13} {context_chars:>14} {elapsed:>9.3f} {storage.writes:>15}")
+
+    # 截断后重写: 摘要应当被重建, 而不是沿用旧轮次
+    truncated = history[: args.turns // 2] + [make_entry(args.turns // 2, args.response_chars // 2)]
+    built = HistoryContext(storage, "s3edit_history_bench").build(truncated)
+    print(f"after truncate to {args.turns // 2}: summary turns={built.get('earlier_summary', {}).get('turns', 0)}, context chars={len(json.dumps(built, ensure_ascii=False))}")
+
+
+if __name__ == "__main__":
+    main()
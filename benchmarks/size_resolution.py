@@ -0,0 +1,110 @@
+"""Micro-benchmark and equivalence check for ImageGenerator.find_closest_size
+
+Compares the prebuilt SizeTable resolver with the original linear scan and
+verifies that both pick the same size for every 'WxH' (and unparsable) input
+in a randomized sample plus a set of edge cases.
+
+    python benchmarks/size_resolution.py --samples 20000
+"""
+
+import argparse
+import os
+import random
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "txt2img"))
+
+from tools.base_image_tool import ImageGenerator, SizeTable  # noqa: E402
+from tools.dalle3 import DallE3Tool  # noqa: E402
+from tools.flux import FluxTool  # noqa: E402
+
+
+def legacy_find_closest_size(requested_size: str, supported_sizes: list) -> str:
+    if not supported_sizes:
+        raise ValueError("supported_sizes must be provided and not empty")
+    if requested_size in supported_sizes:
+        return requested_size
+    try:
+        req_width, req_height = map(int, requested_size.split("x"))
+    except (ValueError, AttributeError):
+        return supported_sizes[0]
+    closest_size = supported_sizes[0]
+    closest_diff = float("inf")
+    for size in supported_sizes:
+        try:
+            width, height = map(int, size.split("x"))
+            req_ratio = req_width / req_height
+            size_ratio = width / height
+            ratio_diff = abs(req_ratio - size_ratio)
+            req_pixels = req_width * req_height
+            size_pixels = width * height
+            pixel_diff = abs(req_pixels - size_pixels)
+            diff = (ratio_diff * 100) + (pixel_diff / 10000)
+            if diff < closest_diff:
+                closest_diff = diff
+                closest_size = size
+        except (ValueError, ZeroDivisionError):
+            continue
+    return closest_size
+
+
+EDGE_CASES = ["", "x", "1024", "1024x", "x1024", "0x0", "1024x0", "0x1024", "-512x512", "1024x1024x1", " 1024x768 ", "1_024x768", "abc", None, 1024]
+
+
+def random_inputs(samples: int, seed: int) -> list:
+    rng = random.Random(seed)
+    inputs = list(EDGE_CASES)
+    for _ in range(samples):
+        inputs.append(f"{rng.randint(1, 4096)}x{rng.randint(1, 4096)}")
+    return inputs
+
+
+def check_equivalence(inputs: list, tables: list[list[str]]) -> int:
+    generator = ImageGenerator({})
+    checked = 0
+    for sizes in tables:
+        table = SizeTable.for_sizes(sizes)
+        for requested in inputs:
+            expected = legacy_find_closest_size(requested, sizes)
+            for got in (generator.find_closest_size(requested, sizes), generator.find_closest_size(requested, table)):
+                if got != expected:
+                    raise AssertionError(f"{requested!r} with {sizes}: expected {expected}, got {got}")
+            checked += 1
+    return checked
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--samples", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    tables = [FluxTool.SUPPORTED_SIZES, DallE3Tool.SUPPORTED_SIZES, ["bad", "1024x0", "512x512", "1024x1024"]]
+    inputs = random_inputs(args.samples, args.seed)
+    print(f"equivalence: {check_equivalence(inputs, tables)} inputs resolved identically")
+
+    generator = ImageGenerator({})
+    workload = [f"{w}x{h}" for w, h in ((1000, 1000), (1920, 1080), (800, 1200), (1366, 768), (640, 480))]
+    sizes = FluxTool.SUPPORTED_SIZES
+    table = FluxTool.SIZE_TABLE
+    rounds = 20000
+    cases = {
+        "legacy scan": lambda: [legacy_find_closest_size(r, sizes) for r in workload],
+        "table (list arg)": lambda: [generator.find_closest_size(r, sizes) for r in workload],
+        "table (prebuilt)": lambda: [generator.find_closest_size(r, table) for r in workload],
+    }
+    baseline = None
+    for name, fn in cases.items():
+        seconds = min(timeit.repeat(fn, number=rounds, repeat=5))
+        per_call = seconds / (rounds * len(workload)) * 1e6
+        baseline = baseline or per_call
+        print(f"{name:<18} {per_call:8.3f} us/call  {baseline / per_call:6.1f}x")
+
+    for ratio in ("16:9", "9:16", "4:3", "portrait", "landscape", "square"):
+        print(f"{ratio:>10} -> flux {generator.find_closest_size(ratio, FluxTool.SIZE_TABLE)}, dall-e-3 {generator.find_closest_size(ratio, DallE3Tool.SIZE_TABLE)}")
+
+
+if __name__ == "__main__":
+    main()
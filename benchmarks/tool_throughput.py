@@ -0,0 +1,383 @@
+"""End-to-end throughput of the tools against local stubs, no network or upstream cost
+
+Starts a stub OpenAI-compatible server, then runs the _invoke generator of
+each tool (flux, dalle3, recraftv3, seededit, s3edit) at several concurrency
+levels. Every tool and concurrency level runs in a fresh child process, so
+the peak RSS reported is that of the run alone and no router, limiter or
+cache state leaks between runs. Prints throughput, p50/p95/p99 latency and
+peak RSS per run.
+
+The stub server answers:
+    POST /v1/images/generations   b64_json images of --image-kb
+    POST /v1/chat/completions     JSON or SSE (--stream-chunks deltas, --chunk-delay
+                                  apart) ending in a markdown link to /images/<id>;
+                                  the deepseek-v3 history analysis gets a JSON verdict
+    GET  /images/<id>             a PNG body of --image-kb
+
+Every request waits --latency seconds, or --tail-latency for a --tail-ratio
+share of requests, to mimic a proxy with a long tail. TOS uploads go to an
+in-memory client, since the TOS SDK addresses buckets by virtual host and
+cannot reach a loopback server; session.storage is an in-memory dict with
+the 1 MB plugin quota.
+
+    python benchmarks/tool_throughput.py --tools flux,s3edit --concurrency 1,4,16 --requests 32
+    python benchmarks/tool_throughput.py --tools flux --tail-ratio 0.1 --tail-latency 2 --hedge-percentile 90
+"""
+
+import sys
+
+if "--child-tool" in sys.argv:
+    # 子进程与插件运行时 (main.py) 一样最先导入 dify_plugin, 由它在其他模块导入前完成 gevent monkey patch;
+    # 在 threading / http.server 之后才打补丁时, openai 首次请求中的子进程调用会一直挂起
+    import dify_plugin  # noqa: F401
+
+import argparse
+import base64
+import itertools
+import json
+import os
+import random
+import resource
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "txt2img"))
+
+TOOLS = {
+    "flux": ("tools.flux", "FluxTool"),
+    "dalle3": ("tools.dalle3", "DallE3Tool"),
+    "recraftv3": ("tools.recraftv3", "RecraftV3Tool"),
+    "seededit": ("tools.seededit", "SeededitTool"),
+    "s3edit": ("tools.s3edit", "S3editTool"),
+}
+STORAGE_QUOTA = 1024 * 1024  # manifest.yaml 中 session.storage 的配额
+
+
+def make_png(size: int) -> bytes:
+    """A valid PNG of roughly size bytes: a 1x1 image padded with a private chunk"""
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return len(data).to_bytes(4, "big") + kind + data + zlib.crc32(kind + data).to_bytes(4, "big")
+
+    header = b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", (1).to_bytes(4, "big") * 2 + b"\x08\x02\x00\x00\x00")
+    body = chunk(b"IDAT", zlib.compress(b"\x00\x00\x00\x00"))
+    padding = chunk(b"bnCh", os.urandom(max(size - 80, 0)))
+    return header + padding + body + chunk(b"IEND", b"")
+
+
+class StubOpenAIServer:
+    """Local OpenAI-compatible server with configurable latency, streaming and payload size"""
+
+    def __init__(self, args):
+        self.args = args
+        self.png = make_png(args.image_kb * 1024)
+        self.b64 = base64.b64encode(self.png).decode()
+        self.requests = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                stub.wait()
+                self._send(200, "image/png", stub.png)
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+                stub.wait()
+                if self.path.endswith("/images/generations"):
+                    images = [{"b64_json": stub.b64} for _ in range(int(body.get("n") or 1))]
+                    self._send_json({"created": int(time.time()), "data": images})
+                elif body.get("model") == "deepseek-v3":
+                    verdict = {"target_image_urls": [], "revised_instruction": "benchmark"}
+                    self._send_json({"choices": [{"message": {"content": "```json\n" + json.dumps(verdict) + "\n```"}}]})
+                elif body.get("stream"):
+                    self._stream()
+                else:
+                    self._send_json({"choices": [{"message": {"content": stub.reply()}}]})
+
+            def _stream(self):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                reply = stub.reply()
+                step = max(len(reply) // stub.args.stream_chunks, 1)
+                for i in range(0, len(reply), step):
+                    event = {"choices": [{"delta": {"content": reply[i : i + step]}}]}
+                    self._chunk(f"data: {json.dumps(event)}\n\n".encode())
+                    time.sleep(stub.args.chunk_delay)
+                self._chunk(b"data: [DONE]\n\n")
+                self._chunk(b"")
+
+            def _chunk(self, data: bytes):
+                self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                self.wfile.flush()
+
+            def _send_json(self, payload: dict):
+                self._send(200, "application/json", json.dumps(payload).encode())
+
+            def _send(self, status: int, content_type: str, body: bytes):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def wait(self):
+        self.requests += 1
+        tail = random.random() < self.args.tail_ratio
+        time.sleep(self.args.tail_latency if tail else self.args.latency)
+
+    def reply(self) -> str:
+        # 不带扩展名的链接, 工具会下载后以 blob 返回
+        filler = "正在生成图片, 请稍候. " * 8
+        return f"{filler}\n\n![image]({self.base_url}/images/{uuid.uuid4().hex})"
+
+
+class InMemoryStorage:
+    """session.storage stand-in holding bytes in a dict, with the plugin's total quota"""
+
+    def __init__(self, quota: int = STORAGE_QUOTA):
+        self.quota = quota
+        self._data: dict[str, bytes] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> bytes:
+        with self._lock:
+            if key not in self._data:
+                raise KeyError(key)
+            return self._data[key]
+
+    def set(self, key: str, value: bytes) -> None:
+        with self._lock:
+            used = sum(len(v) for k, v in self._data.items() if k != key)
+            if used + len(value) > self.quota:
+                raise RuntimeError("session.storage quota exceeded")
+            self._data[key] = bytes(value)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def exist(self, key: str) -> bool:
+        with self._lock:
+            return key in self._data
+
+
+class FakeTosClient:
+    """In-process stand-in for tos.TosClientV2 covering the calls tos_store makes"""
+
+    def __init__(self):
+        self.objects: dict[tuple[str, str], int] = {}
+        self.parts: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def head_object(self, bucket: str, key: str):
+        from tos.exceptions import TosServerError
+
+        with self._lock:
+            if (bucket, key) in self.objects:
+                return SimpleNamespace(content_length=self.objects[bucket, key])
+        error = TosServerError.__new__(TosServerError)
+        error.status_code = 404
+        raise error
+
+    def put_object(self, bucket: str, key: str, content=None):
+        size = len(content.read() if hasattr(content, "read") else content or b"")
+        with self._lock:
+            self.objects[bucket, key] = size
+
+    def create_multipart_upload(self, bucket: str, key: str):
+        upload_id = uuid.uuid4().hex
+        with self._lock:
+            self.parts[upload_id] = 0
+        return SimpleNamespace(upload_id=upload_id)
+
+    def upload_part(self, bucket: str, key: str, upload_id: str, part_number: int, content=None):
+        with self._lock:
+            self.parts[upload_id] += len(content)
+        return SimpleNamespace(etag=f"{upload_id}-{part_number}")
+
+    def complete_multipart_upload(self, bucket: str, key: str, upload_id: str, parts=None):
+        with self._lock:
+            self.objects[bucket, key] = self.parts.pop(upload_id)
+
+    def abort_multipart_upload(self, bucket: str, key: str, upload_id: str):
+        with self._lock:
+            self.parts.pop(upload_id, None)
+
+
+def tool_parameters(name: str, args, base_url: str, worker: int, turn: int) -> dict:
+    if name in ("flux", "dalle3", "recraftv3"):
+        return {
+            "prompt": "a lighthouse at dusk",
+            "size": "1024x1024",
+            "n": args.n,
+            "hedge_percentile": args.hedge_percentile,
+            "output_mode": args.output_mode,
+        }
+    image = SimpleNamespace(type="image", url=f"{base_url}/images/upload-{worker}-{turn}")
+    parameters = {"instruction": "把天空换成晚霞", "image_files": [image], "stream": args.stream, "model": "gpt-4o-all"}
+    if name == "s3edit":
+        # 每个并发工作者是一个会话, 从第二轮起会触发历史分析
+        parameters.update(conversation_id=f"bench-{worker}", dialogue_count=turn)
+    return parameters
+
+
+def run_child(args) -> dict:
+    """Run one tool at one concurrency level and return its measurements"""
+    import importlib
+    import logging
+
+    from dify_plugin.entities.tool import ToolInvokeMessage, ToolRuntime
+    from openai import APIError
+
+    from tools import tos_store
+    from tools.rate_limiter import RateLimitExceeded
+
+    fake_tos = FakeTosClient()
+    tos_store.get_tos_client = lambda credentials: fake_tos
+    module_name, class_name = TOOLS[args.child_tool]
+    tool_cls = getattr(importlib.import_module(module_name), class_name)
+    # 子进程不经过 main.py 的 configure_logging; 按 --log-level 设置根级别, 默认只保留告警, 以免日志输出主导耗时
+    logging.getLogger().setLevel(getattr(logging, args.log_level.upper()))
+
+    credentials = {
+        "openai_api_key": "sk-benchmark",
+        "openai_base_url": args.base_url,
+        "VOLCENGINE_TOS_ACCESS_KEY": "ak",
+        "VOLCENGINE_TOS_SECRET_KEY": "sk",
+        "VOLCENGINE_TOS_ENDPOINT": "tos-cn-beijing.volces.com",
+        "VOLCENGINE_TOS_REGION": "cn-beijing",
+        "VOLCENGINE_TOS_BUCKET_NAME": "benchmark",
+    }
+    session = SimpleNamespace(storage=InMemoryStorage())
+    turns = itertools.count()
+
+    def expected_failure(e: BaseException) -> bool:
+        """Upstream failures a tool reports by raising; anything else is a bug in the tool or the harness"""
+        if isinstance(e, (APIError, RateLimitExceeded, TimeoutError)):
+            return True
+        # seededit / s3edit 把上游错误包装成 BaseException("API Error: ...")
+        return type(e) is BaseException and str(e).startswith("API Error")
+
+    def invoke(worker: int) -> tuple[float, bool]:
+        # 与插件运行时一样通过构造函数创建工具, 由 Tool.__init__ 设置 response_type 等属性
+        tool = tool_cls(runtime=ToolRuntime(credentials=credentials, user_id="benchmark", session_id=None), session=session)
+        parameters = tool_parameters(args.child_tool, args, args.base_url, worker % args.child_concurrency, next(turns))
+        start = time.perf_counter()
+        try:
+            # 只有文本消息说明没有拿到图片 (限流, 下载失败等)
+            ok = any(m.type != ToolInvokeMessage.MessageType.TEXT for m in tool._invoke(parameters))
+        except BaseException as e:
+            if not expected_failure(e):
+                raise
+            ok = False
+        return time.perf_counter() - start, ok
+
+    # 预热: 导入, 连接池与事件循环的首次开销不计入
+    invoke(0)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.child_concurrency) as pool:
+        results = list(pool.map(invoke, range(args.requests)))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for latency, _ in results)
+
+    def percentile(p: float) -> float:
+        return latencies[min(int(len(latencies) * p / 100), len(latencies) - 1)] * 1000
+
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        "tool": args.child_tool,
+        "concurrency": args.child_concurrency,
+        "requests": len(results),
+        "errors": sum(1 for _, ok in results if not ok),
+        "throughput": len(results) / elapsed,
+        "p50_ms": percentile(50),
+        "p95_ms": percentile(95),
+        "p99_ms": percentile(99),
+        "peak_rss_mb": peak_kb / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tools", default=",".join(TOOLS))
+    parser.add_argument("--concurrency", default="1,4,16")
+    parser.add_argument("--requests", type=int, default=32, help="invocations per tool and concurrency level")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds the stub waits before answering")
+    parser.add_argument("--tail-latency", type=float, default=0.0)
+    parser.add_argument("--tail-ratio", type=float, default=0.0)
+    parser.add_argument("--image-kb", type=int, default=512)
+    parser.add_argument("--n", type=int, default=1, help="images per generation call")
+    parser.add_argument("--stream", action="store_true", help="stream seededit/s3edit completions")
+    parser.add_argument("--stream-chunks", type=int, default=20)
+    parser.add_argument("--chunk-delay", type=float, default=0.005)
+    parser.add_argument("--hedge-percentile", type=float, default=0)
+    parser.add_argument("--output-mode", choices=["blob", "url"], default="blob", help="how generation tools return images")
+    parser.add_argument("--log-level", default="warning")
+    parser.add_argument("--child-timeout", type=float, default=600, help="seconds before a tool/concurrency run is abandoned")
+    parser.add_argument("--child-tool", help=argparse.SUPPRESS)
+    parser.add_argument("--child-concurrency", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--base-url", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child_tool:
+        print(json.dumps(run_child(args)), flush=True)
+        # gevent 在 3.13 上替换的 threading._shutdown 会一直 join 空闲的线程池 worker (如 s3edit-ingest),
+        # 结果已输出, 直接退出而不等解释器收尾
+        os._exit(0)
+
+    stub = StubOpenAIServer(args)
+    tools = [name.strip() for name in args.tools.split(",") if name.strip()]
+    levels = [int(level) for level in args.concurrency.split(",")]
+    print(f"stub={stub.base_url} latency={args.latency}s tail={args.tail_ratio:.0%}@{args.tail_latency}s image={args.image_kb}KB stream={args.stream}")
+    print(f"{'tool':<10} {'conc':>4} {'reqs':>5} {'errors':>6} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'peak RSS MB':>12}")
+    passthrough = sys.argv[1:]
+    with tempfile.TemporaryDirectory() as cache_dir:
+        # 下载缓存放在临时目录, 不受之前运行的影响
+        env = dict(os.environ, TXT2IMG_FETCH_CACHE_DIR=cache_dir)
+        for name in tools:
+            for level in levels:
+                try:
+                    output = subprocess.run(
+                        [sys.executable, __file__, *passthrough, "--child-tool", name, "--child-concurrency", str(level), "--base-url", stub.base_url],
+                        capture_output=True,
+                        text=True,
+                        env=env,
+                        timeout=args.child_timeout,
+                    )
+                except subprocess.TimeoutExpired:
+                    print(f"{name:<10} {level:>4} failed: no result within {args.child_timeout:g}s")
+                    continue
+                if output.returncode != 0:
+                    print(f"{name:<10} {level:>4} failed:\n{output.stderr.strip()[-2000:]}")
+                    continue
+                r = json.loads(output.stdout.strip().splitlines()[-1])
+                print(
+                    f"{r['tool']:<10} {r['concurrency']:>4} {r['requests']:>5} {r['errors']:>6} {r['throughput']:>8.1f} "
+                    f"{r['p50_ms']:>8.0f} {r['p95_ms']:>8.0f} {r['p99_ms']:>8.0f} {r['peak_rss_mb']:>12.1f}"
+                )
+    print(f"stub requests served: {stub.requests}")
+
+
+if __name__ == "__main__":
+    main()
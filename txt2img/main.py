@@ -1,5 +1,9 @@
 from dify_plugin import Plugin, DifyPluginEnv
 
+from tools.log_config import configure_logging
+
+configure_logging()
+
 plugin = Plugin(DifyPluginEnv(MAX_REQUEST_TIMEOUT=120))
 
 if __name__ == '__main__':
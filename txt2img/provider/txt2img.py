@@ -1,19 +1,38 @@
 import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
 from typing import Any
 
-import tos
 from dify_plugin import ToolProvider
 from dify_plugin.errors.tool import ToolProviderCredentialValidationError
-from openai import OpenAI
 from yarl import URL
 
-logging.basicConfig(level=logging.INFO)
+from tools.client_pool import credential_fingerprint
+from tools.endpoint_router import parse_base_urls
+
 logger = logging.getLogger(__name__)
 
+# 各项检查并发执行, 每项有自己的超时秒数
+OPENAI_VALIDATION_TIMEOUT = 15.0
+TOS_VALIDATION_TIMEOUT = 15.0
+# 校验通过的凭据按摘要缓存的秒数, 0 表示不缓存
+VALIDATION_CACHE_TTL = float(os.environ.get("TXT2IMG_VALIDATION_CACHE_TTL") or 600)
+# 选择 "refresh" 时忽略缓存重新校验, 该字段本身不计入凭据摘要
+# 它是保存下来的凭据字段, 改回 "cached" 之前每次校验都会跳过缓存
+REVALIDATE_FIELD = "revalidate"
+
+_validated: dict[str, float] = {}
+_validated_lock = threading.Lock()
+
+
+def _fingerprint(credentials: dict[str, Any]) -> str:
+    return credential_fingerprint(*(f"{key}={credentials[key]}" for key in sorted(credentials) if key != REVALIDATE_FIELD))
+
 
 class Txt2imgProvider(ToolProvider):
     def _validate_credentials(self, credentials: dict[str, Any]) -> None:
-        logger.info(f"verify credentials: {credentials}")
         openai_api_key = credentials.get("openai_api_key")
         openai_base_url = credentials.get("openai_base_url")
 
@@ -22,26 +41,84 @@ class Txt2imgProvider(ToolProvider):
 
         if not openai_base_url:
             raise ToolProviderCredentialValidationError("OpenAI base URL is required")
-        elif URL(openai_base_url).path.endswith("/v1"):
-            raise ToolProviderCredentialValidationError("OpenAI base URL should not end with '/v1'")
-        else:
-            openai_base_url = str(URL(openai_base_url) / "v1")
 
-        client = OpenAI(api_key=openai_api_key, base_url=openai_base_url)
+        try:
+            endpoints = parse_base_urls(credentials)
+        except ValueError as e:
+            raise ToolProviderCredentialValidationError(str(e))
+
+        for base_url, _ in endpoints:
+            if URL(base_url).path.endswith("/v1"):
+                raise ToolProviderCredentialValidationError("OpenAI base URL should not end with '/v1'" + (f": {base_url}" if len(endpoints) > 1 else ""))
+
+        # 只记录摘要和端点, 不记录密钥
+        fingerprint = _fingerprint(credentials)
+        refresh = credentials.get(REVALIDATE_FIELD) == "refresh"
+        logger.info("verify credentials [fingerprint=%s, endpoints=%s, refresh=%s]", fingerprint[:12], [url for url, _ in endpoints], refresh)
+        if not refresh and VALIDATION_CACHE_TTL > 0:
+            with _validated_lock:
+                expires = _validated.get(fingerprint, 0.0)
+            if expires > time.monotonic():
+                logger.info("Credentials validated recently, skipping checks [fingerprint=%s]", fingerprint[:12])
+                return
 
+        checks = [(base_url, OPENAI_VALIDATION_TIMEOUT, self._check_openai, (openai_api_key, base_url)) for base_url, _ in endpoints]
+        checks.append(("tos", TOS_VALIDATION_TIMEOUT, self._check_tos, (credentials,)))
+        # 不等待超时的检查结束, 线程在后台自行退出
+        executor = ThreadPoolExecutor(max_workers=len(checks), thread_name_prefix="validate-credentials")
+        try:
+            start = time.monotonic()
+            futures = [executor.submit(check, *args) for _, _, check, args in checks]
+            for (_, timeout, _, _), future in zip(checks, futures):
+                wait([future], timeout=max(start + timeout - time.monotonic(), 0))
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        errors = []
+        for (name, timeout, _, _), future in zip(checks, futures):
+            if not future.done():
+                error = f"timed out after {timeout:g}s"
+            elif future.exception() is not None:
+                error = str(future.exception())
+            else:
+                continue
+            if name == "tos":
+                errors.append(f"tos密钥验证失败: {error}")
+            else:
+                errors.append(f"{name}: {error}" if len(endpoints) > 1 else error)
+        if errors:
+            raise ToolProviderCredentialValidationError("\n".join(errors))
+
+        if VALIDATION_CACHE_TTL > 0:
+            with _validated_lock:
+                now = time.monotonic()
+                for key in [k for k, expires in _validated.items() if expires <= now]:
+                    del _validated[key]
+                _validated[fingerprint] = now + VALIDATION_CACHE_TTL
+
+    @staticmethod
+    def _check_openai(api_key: str, base_url: str) -> None:
+        # SDK 只在校验凭据时才需要, 不在插件启动时导入
+        from openai import OpenAI
+
+        client = OpenAI(api_key=api_key, base_url=str(URL(base_url) / "v1"), timeout=OPENAI_VALIDATION_TIMEOUT, max_retries=0)
         try:
             # Validate credentials by listing models
             client.models.list()
-        except Exception as e:
-            raise ToolProviderCredentialValidationError(str(e))
+        finally:
+            client.close()
+
+    @staticmethod
+    def _check_tos(credentials: dict[str, Any]) -> None:
+        import tos
 
         tos_client = tos.TosClientV2(
             ak=credentials["VOLCENGINE_TOS_ACCESS_KEY"],
             sk=credentials["VOLCENGINE_TOS_SECRET_KEY"],
             endpoint=credentials["VOLCENGINE_TOS_ENDPOINT"],
             region=credentials["VOLCENGINE_TOS_REGION"],
+            connection_time=TOS_VALIDATION_TIMEOUT,
+            socket_timeout=TOS_VALIDATION_TIMEOUT,
+            max_retry_count=0,
         )
-        try:
-            tos_client.head_bucket(bucket=credentials["VOLCENGINE_TOS_BUCKET_NAME"])
-        except Exception as e:
-            raise ToolProviderCredentialValidationError(f"tos密钥验证失败: {str(e)}")
+        tos_client.head_bucket(bucket=credentials["VOLCENGINE_TOS_BUCKET_NAME"])
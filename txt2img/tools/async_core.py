@@ -0,0 +1,190 @@
+import asyncio
+import contextvars
+import logging
+import os
+import threading
+from collections.abc import AsyncIterator, Coroutine, Iterator
+from concurrent.futures import Future
+from contextlib import nullcontext
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import httpx
+
+logger = logging.getLogger(__name__)
+
+# 原始 HTTP 请求 (对话补全) 共享的异步连接池参数
+HTTP_MAX_CONNECTIONS = 64
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 16
+HTTP_KEEPALIVE_EXPIRY = 30.0
+
+
+class EventLoopThread:
+    """One asyncio event loop per process, running in a daemon thread
+
+    Synchronous code (the Tool._invoke generators) hands coroutines to the
+    loop with submit()/run() and drives async generators with iterate(), so
+    all network I/O of every in-flight invocation shares a single thread.
+    Coroutines run in a copy of the caller's contextvars context, which keeps
+    tracing spans nested under the invocation that started them.
+    """
+
+    def __init__(self, name: str = "txt2img-io"):
+        self.name = name
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._thread: threading.Thread | None = None
+        self._pid: int | None = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            # fork 出的子进程没有父进程的循环线程, 需要重新启动
+            if self._loop is None or self._pid != os.getpid() or not self._thread.is_alive():
+                self._start()
+            return self._loop
+
+    def _start(self) -> None:
+        loop = asyncio.new_event_loop()
+        ready = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(loop)
+            loop.call_soon(ready.set)
+            loop.run_forever()
+
+        thread = threading.Thread(target=run, name=self.name, daemon=True)
+        thread.start()
+        ready.wait()
+        self._loop, self._thread, self._pid = loop, thread, os.getpid()
+        logger.info("Started asyncio I/O loop [thread=%s]", self.name)
+
+    def submit(self, coro: Coroutine, context: contextvars.Context | None = None) -> Future:
+        """Schedule coro on the loop and return a concurrent Future for its result
+
+        Cancelling the returned future cancels the task on the loop.
+        """
+        context = context if context is not None else contextvars.copy_context()
+        loop = self.loop
+        future: Future = Future()
+
+        def start():
+            if future.cancelled():
+                coro.close()
+                return
+            task = loop.create_task(coro, context=context)
+            future.add_done_callback(lambda f: f.cancelled() and loop.call_soon_threadsafe(task.cancel))
+            task.add_done_callback(lambda t: _copy_outcome(t, future))
+
+        loop.call_soon_threadsafe(start)
+        return future
+
+    def run(self, coro: Coroutine, timeout: float | None = None, context: contextvars.Context | None = None):
+        """Run coro on the loop and block until it finishes"""
+        future = self.submit(coro, context)
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            future.cancel()
+            raise
+
+    def iterate(self, agen: AsyncIterator, timeout: float | None = None) -> Iterator:
+        """Expose an async generator as a blocking generator
+
+        Every step runs in the same context, so spans opened inside the async
+        generator stay open across steps. Closing the returned generator early
+        closes the async one on the loop.
+        """
+        context = contextvars.copy_context()
+        try:
+            while True:
+                try:
+                    item = self.run(_anext(agen), timeout, context)
+                except StopAsyncIteration:
+                    return
+                yield item
+        finally:
+            self.run(_aclose(agen), context=context)
+
+
+def _copy_outcome(task: asyncio.Task, future: Future) -> None:
+    if future.done():
+        return
+    try:
+        if task.cancelled():
+            future.cancel()
+        elif task.exception() is not None:
+            future.set_exception(task.exception())
+        else:
+            future.set_result(task.result())
+    except Exception:
+        # 调用方刚好同时取消了 future
+        pass
+
+
+async def _anext(agen: AsyncIterator):
+    return await agen.__anext__()
+
+
+async def _aclose(agen: AsyncIterator) -> None:
+    aclose = getattr(agen, "aclose", None)
+    if aclose is not None:
+        await aclose()
+
+
+io_loop = EventLoopThread()
+
+_http_clients: dict[int, "httpx.AsyncClient"] = {}
+
+
+def get_http_client() -> "httpx.AsyncClient":
+    """Return the shared httpx.AsyncClient of the running loop; call on the loop only"""
+    import httpx
+
+    loop_id = id(asyncio.get_running_loop())
+    client = _http_clients.get(loop_id)
+    if client is None:
+        client = _http_clients[loop_id] = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(120.0, connect=10.0),
+        )
+    return client
+
+
+async def apost_json(url: str, headers: dict, payload: dict, timeout: float = 60, limiter=None) -> dict:
+    async with limiter.aslot() if limiter is not None else nullcontext():
+        response = await get_http_client().post(url, headers=headers, json=payload, timeout=timeout)
+        if limiter is not None and response.is_success:
+            # 错误响应由 aslot 在异常中处理
+            limiter.observe(response.status_code, response.headers)
+        response.raise_for_status()
+        return response.json()
+
+
+async def astream_post(url: str, headers: dict, payload: dict, timeout: float = 60, limiter=None) -> AsyncIterator[bytes]:
+    # 流式响应在整个读取期间占用一个并发槽位
+    async with limiter.aslot() if limiter is not None else nullcontext():
+        async with get_http_client().stream("POST", url, headers=headers, json=payload, timeout=timeout) as response:
+            if limiter is not None and response.is_success:
+                limiter.observe(response.status_code, response.headers)
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes():
+                yield chunk
+
+
+def post_json(url: str, headers: dict, payload: dict, timeout: float = 60, limiter=None) -> dict:
+    """POST a JSON payload on the I/O loop and return the decoded JSON response
+
+    With a rate_limiter.EndpointLimiter the request waits for a slot first
+    and the response's throttling headers are fed back to it.
+    """
+    return io_loop.run(apost_json(url, headers, payload, timeout, limiter))
+
+
+def stream_post(url: str, headers: dict, payload: dict, timeout: float = 60, limiter=None) -> Iterator[bytes]:
+    """POST a JSON payload on the I/O loop and yield the response body in chunks as they arrive"""
+    return io_loop.iterate(astream_post(url, headers, payload, timeout, limiter))
@@ -1,8 +1,137 @@
+import asyncio
 import base64
-from collections.abc import Generator
-from openai import OpenAI
+import functools
+import hashlib
+import io
+import logging
+from collections.abc import AsyncGenerator, Generator
+
+from dify_plugin.entities.tool import ToolInvokeMessage
 from yarl import URL
 
+from .async_core import io_loop
+from .client_pool import async_openai_clients
+from .endpoint_router import get_router
+from .hedging import hedger
+from .image_postprocess import PostProcessOptions, arun_in_pool, transcode
+from .image_sniff import EXTENSIONS, sniff
+from .rate_limiter import get_limiter
+from .result_cache import GenerationCache
+from .tos_store import TosObjectStore
+from .tracing import span
+
+logger = logging.getLogger(__name__)
+
+# 分块解码的字符数, 必须是 4 的倍数
+DECODE_CHUNK_SIZE = 256 * 1024
+_BASE64_WHITESPACE = (" ", "\n", "\r", "\t")
+
+# 多图生成时拆分为 n 个单图请求在 I/O 循环上并发发送, 进程内同时进行的请求数不超过该值
+MAX_IMAGES = 4
+FAN_OUT_MAX_CONCURRENCY = 8
+_fan_out_slots = asyncio.Semaphore(FAN_OUT_MAX_CONCURRENCY)
+
+# output_mode=url 时生成的图片按内容哈希上传到 TOS 的该前缀下, 返回图片链接而不是 blob
+OUTPUT_MODES = {"blob", "url"}
+TOS_OUTPUT_PREFIX = "txt2img"
+
+# 仅给出宽高比时, 宽高比相同的尺寸中优先选择接近该像素量的
+RATIO_TARGET_PIXELS = 1024 * 1024
+NAMED_RATIOS = {"square": (1, 1), "landscape": (4, 3), "portrait": (3, 4)}
+
+
+class SizeTable:
+    """Supported sizes of a model parsed once, with a memoized closest-size resolver
+
+    Each entry keeps the parsed aspect ratio and pixel count of a size, so
+    resolving a request no longer re-splits every supported size. For 'WxH'
+    input the result is identical to the original linear scan.
+    """
+
+    _tables: dict[tuple, "SizeTable"] = {}
+
+    def __init__(self, sizes: list[str]):
+        self.sizes = list(sizes)
+        self._members = frozenset(self.sizes)
+        self._entries = []
+        for size in self.sizes:
+            try:
+                width, height = map(int, size.split("x"))
+                self._entries.append((size, width / height, width * height))
+            except (ValueError, ZeroDivisionError):
+                continue
+        self._resolve_cached = functools.lru_cache(maxsize=512)(self._resolve)
+
+    @classmethod
+    def for_sizes(cls, sizes) -> "SizeTable":
+        """Return the shared table for a list of sizes, building it on first use"""
+        key = tuple(sizes)
+        table = cls._tables.get(key)
+        if table is None:
+            table = cls._tables[key] = cls(key)
+        return table
+
+    def __len__(self) -> int:
+        return len(self.sizes)
+
+    def resolve(self, requested_size) -> str:
+        """Return the supported size closest to a 'WxH', 'W:H' or named aspect ratio request"""
+        if not isinstance(requested_size, str):
+            return self.sizes[0]
+        return self._resolve_cached(requested_size)
+
+    def _resolve(self, requested_size: str) -> str:
+        # If the requested size is in the supported sizes, return it
+        if requested_size in self._members:
+            return requested_size
+
+        ratio = self._parse_ratio(requested_size)
+        if ratio is not None:
+            return self._closest_to_ratio(ratio)
+
+        try:
+            req_width, req_height = map(int, requested_size.split("x"))
+        except ValueError:
+            # If parsing fails, return the default size
+            return self.sizes[0]
+        if req_height == 0:
+            return self.sizes[0]
+
+        # Combined difference (weighted) of aspect ratio and total pixels
+        req_ratio = req_width / req_height
+        req_pixels = req_width * req_height
+        closest_size = self.sizes[0]
+        closest_diff = float("inf")
+        for size, size_ratio, size_pixels in self._entries:
+            diff = (abs(req_ratio - size_ratio) * 100) + (abs(req_pixels - size_pixels) / 10000)
+            if diff < closest_diff:
+                closest_diff = diff
+                closest_size = size
+        return closest_size
+
+    def _closest_to_ratio(self, ratio: float) -> str:
+        """Pick the size with the nearest aspect ratio, preferring about RATIO_TARGET_PIXELS on ties"""
+        if not self._entries:
+            return self.sizes[0]
+        best = min(self._entries, key=lambda e: (round(abs(ratio - e[1]), 2), abs(RATIO_TARGET_PIXELS - e[2])))
+        return best[0]
+
+    @staticmethod
+    def _parse_ratio(requested_size: str) -> float | None:
+        """Parse 'W:H' or a named aspect ratio, None for anything else"""
+        named = NAMED_RATIOS.get(requested_size.strip().lower())
+        if named is not None:
+            return named[0] / named[1]
+        if ":" not in requested_size:
+            return None
+        try:
+            ratio_w, ratio_h = (float(part) for part in requested_size.split(":"))
+        except ValueError:
+            return None
+        if ratio_w <= 0 or ratio_h <= 0:
+            return None
+        return ratio_w / ratio_h
+
 
 class ImageGenerator:
     """Helper class that encapsulates image generation logic"""
@@ -10,23 +139,22 @@ class ImageGenerator:
     def __init__(self, credentials: dict):
         self.credentials = credentials
 
-    def get_client(self):
-        """Create OpenAI client with credentials"""
-        openai_base_url = self.credentials.get("openai_base_url", None)
-        openai_base_url = str(URL(openai_base_url) / "v1")
-
-        return OpenAI(
+    def get_async_client(self, base_url: str | None = None):
+        """Return the pooled AsyncOpenAI client for these credentials, for use on the I/O loop"""
+        openai_base_url = str(URL(base_url or self.credentials.get("openai_base_url", None)) / "v1")
+        return async_openai_clients.get(
             api_key=self.credentials["openai_api_key"],
             base_url=openai_base_url,
         )
 
-    def find_closest_size(self, requested_size: str, supported_sizes: list) -> str:
+    def find_closest_size(self, requested_size: str, supported_sizes: "list | SizeTable") -> str:
         """Find the closest supported size to the requested size
 
         Args:
-            requested_size: The size requested by the user (e.g. '1024x1024')
+            requested_size: The size requested by the user (e.g. '1024x1024'),
+                            or an aspect ratio such as '16:9' or 'portrait'
             supported_sizes: List of sizes supported by the model (e.g. ['1024x1024', '512x512'])
-                             Must be provided and not empty
+                             or its prebuilt SizeTable. Must be provided and not empty
 
         Returns:
             The closest supported size
@@ -34,75 +162,137 @@ class ImageGenerator:
         if not supported_sizes:
             raise ValueError("supported_sizes must be provided and not empty")
 
-        # If the requested size is in the supported sizes, return it
-        if requested_size in supported_sizes:
-            return requested_size
+        table = supported_sizes if isinstance(supported_sizes, SizeTable) else SizeTable.for_sizes(supported_sizes)
+        return table.resolve(requested_size)
 
-        # Parse the requested size
-        try:
-            req_width, req_height = map(int, requested_size.split("x"))
-        except (ValueError, AttributeError):
-            # If parsing fails, return the default size
-            return supported_sizes[0]
-
-        # Find the closest size by comparing aspect ratios and total pixels
-        closest_size = supported_sizes[0]
-        closest_diff = float("inf")
-
-        for size in supported_sizes:
-            try:
-                width, height = map(int, size.split("x"))
+    async def agenerate_image(
+        self,
+        prompt: str,
+        model: str,
+        size: str,
+        supported_sizes: "list | SizeTable",
+        style: str = None,
+        quality: str = None,
+        n: int = 1,
+        queue_deadline: float | None = None,
+    ):
+        """Generate images with one API call on the shared I/O loop
 
-                # Calculate aspect ratio difference
-                req_ratio = req_width / req_height
-                size_ratio = width / height
-                ratio_diff = abs(req_ratio - size_ratio)
+        queue_deadline overrides how long the call may wait in the endpoint's
+        rate limiter; hedged duplicates pass 0 so they never queue.
+        """
+        router = get_router(self.credentials)
+        endpoint = router.choose()
+        client = self.get_async_client(endpoint.base_url)
+        actual_size = self.find_closest_size(size, supported_sizes)
 
-                # Calculate total pixels difference
-                req_pixels = req_width * req_height
-                size_pixels = width * height
-                pixel_diff = abs(req_pixels - size_pixels)
+        limiter = get_limiter(endpoint.base_url)
+        with span("images.generate", model=model, size=actual_size, n=n, endpoint=endpoint.base_url):
+            async with limiter.aslot(queue_deadline):
+                with router.track(endpoint):
+                    raw = await client.images.with_raw_response.generate(
+                        prompt=prompt,
+                        model=model,
+                        size=actual_size,
+                        n=n,
+                        style=style,
+                        quality=quality,
+                        response_format="b64_json",
+                    )
+                    limiter.observe(raw.status_code, raw.headers)
+                    return raw.parse()
 
-                # Combined difference (weighted)
-                diff = (ratio_diff * 100) + (pixel_diff / 10000)
+    def generate_images(
+        self,
+        prompt: str,
+        model: str,
+        size: str,
+        supported_sizes: "list | SizeTable",
+        style: str = None,
+        quality: str = None,
+        n: int = 1,
+        hedge_percentile: float = 0,
+        postprocess: PostProcessOptions | None = None,
+    ) -> Generator[tuple[str, bytes] | Exception, None, None]:
+        """Generate n images, yielding (mime_type, blob) for each as soon as it is ready
 
-                if diff < closest_diff:
-                    closest_diff = diff
-                    closest_size = size
-            except (ValueError, ZeroDivisionError):
-                continue
+        For n > 1 the request is fanned out as n single-image calls, since many
+        OpenAI-compatible proxies ignore or reject n > 1. The calls run as tasks
+        on the shared I/O loop rather than on worker threads. A failed call
+        yields its exception in place of an image instead of stopping the others.
 
-        return closest_size
+        With hedge_percentile > 0 each call that runs past that percentile of
+        the model's recent latency is hedged with a duplicate (see hedging.Hedger).
+        postprocess optionally transcodes/downscales each image in the shared
+        image worker pool (see image_postprocess).
+        """
+        yield from io_loop.iterate(
+            self.agenerate_images(
+                prompt, model, size, supported_sizes, style=style, quality=quality, n=n, hedge_percentile=hedge_percentile, postprocess=postprocess
+            )
+        )
 
-    def generate_image(
+    async def agenerate_images(
         self,
         prompt: str,
         model: str,
         size: str,
-        supported_sizes: list,
+        supported_sizes: "list | SizeTable",
         style: str = None,
         quality: str = None,
         n: int = 1,
-    ):
-        """Generate image using OpenAI API"""
-        client = self.get_client()
+        hedge_percentile: float = 0,
+        postprocess: PostProcessOptions | None = None,
+    ) -> AsyncGenerator[tuple[str, bytes] | Exception, None]:
+        if n <= 1:
+            for image in await self._agenerate_decoded(prompt, model, size, supported_sizes, style, quality, hedge_percentile, postprocess):
+                yield image
+            return
 
-        # Find the closest supported size
-        actual_size = self.find_closest_size(size, supported_sizes)
+        tasks = [
+            asyncio.ensure_future(self._agenerate_decoded(prompt, model, size, supported_sizes, style, quality, hedge_percentile, postprocess))
+            for _ in range(n)
+        ]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                try:
+                    images = await next_done
+                except Exception as e:
+                    logger.error(f"Fan-out image generation failed: {e}")
+                    yield e
+                    continue
+                for image in images:
+                    yield image
+        finally:
+            # 调用方提前结束时取消仍在进行的请求
+            for task in tasks:
+                task.cancel()
 
-        return client.images.generate(
-            prompt=prompt,
-            model=model,
-            size=actual_size,
-            n=n,
-            style=style,
-            quality=quality,
-            response_format="b64_json",
-        )
+    async def _agenerate_decoded(
+        self, prompt, model, size, supported_sizes, style, quality, hedge_percentile=0, postprocess=None
+    ) -> list[tuple[str, bytes]]:
+        async with _fan_out_slots:
+            # 对冲请求与原请求共用一个扇出槽位
+            response = await hedger.run(
+                model,
+                hedge_percentile,
+                lambda hedge: self.agenerate_image(
+                    prompt, model, size, supported_sizes, style=style, quality=quality, n=1, queue_deadline=0 if hedge else None
+                ),
+            )
+        # 解码是 CPU 密集操作, 放到线程中执行, 不阻塞循环上的其他请求; 需要转码时放到并发受限的图片线程池
+        if postprocess is not None:
+            return await arun_in_pool(lambda: list(self.process_response(response, postprocess)))
+        return await asyncio.to_thread(lambda: list(self.process_response(response)))
 
     @staticmethod
-    def process_response(response) -> Generator[tuple[str, bytes], None, None]:
-        """Process API response and return mime_type and blob data"""
+    def process_response(response, postprocess: PostProcessOptions | None = None) -> Generator[tuple[str, bytes], None, None]:
+        """Process API response and return mime_type and blob data
+
+        Each image's base64 text is dropped from the response as soon as it is
+        decoded, so at most one encoded payload is alive next to its bytes.
+        With postprocess each image is also transcoded before it is yielded.
+        """
         # 处理字典格式的响应
         if isinstance(response, dict) and "data" in response:
             data = response["data"]
@@ -112,22 +302,185 @@ class ImageGenerator:
 
         for image in data:
             # 检查是否有 b64_json 字段
-            b64_json = (
-                getattr(image, "b64_json", None)
-                if not isinstance(image, dict)
-                else image.get("b64_json")
-            )
-            if not b64_json:
+            if not ImageGenerator._get_b64(image):
                 continue
-            mime_type, blob = ImageGenerator.decode_image(b64_json)
-            yield mime_type, blob
+            # 取出后立即从响应中释放, 且不在生成器局部变量里保留文本或 blob 的引用
+            yield transcode(*ImageGenerator.decode_image(ImageGenerator._take_b64(image)), postprocess)
+
+    @staticmethod
+    def _get_b64(image) -> str | None:
+        return (
+            getattr(image, "b64_json", None)
+            if not isinstance(image, dict)
+            else image.get("b64_json")
+        )
+
+    @staticmethod
+    def _take_b64(image) -> str:
+        """Return the base64 text of an image and drop the response's reference to it"""
+        b64_json = ImageGenerator._get_b64(image)
+        try:
+            if isinstance(image, dict):
+                image["b64_json"] = None
+            else:
+                image.b64_json = None
+        except Exception:
+            # 只读对象无法释放, 不影响解码
+            pass
+        return b64_json
 
     @staticmethod
     def decode_image(base64_image: str) -> tuple[str, bytes]:
-        """Decode base64 image with MIME type detection"""
-        if not base64_image.startswith("data:image"):
-            return ("image/png", base64.b64decode(base64_image))
+        """Decode base64 image with MIME type detection
+
+        The payload is decoded in DECODE_CHUNK_SIZE slices into a single
+        output buffer instead of splitting the data URI into full copies.
+        The MIME type is read from the image header; the data URI type (or
+        image/png) is only used when the header is not recognized.
+        """
+        mime_type = "image/png"
+        start = 0
+        if base64_image.startswith("data:image"):
+            comma = base64_image.find(",")
+            header = base64_image[5:comma] if comma != -1 else base64_image[5:]
+            mime_type = header.split(";")[0]
+            start = comma + 1 if comma != -1 else len(base64_image)
+
+        output = io.BytesIO()
+        carry = ""
+        for offset in range(start, len(base64_image), DECODE_CHUNK_SIZE):
+            piece = carry + base64_image[offset : offset + DECODE_CHUNK_SIZE]
+            if any(ch in piece for ch in _BASE64_WHITESPACE):
+                piece = "".join(piece.split())
+            usable = len(piece) - len(piece) % 4
+            output.write(base64.b64decode(piece[:usable]))
+            carry = piece[usable:]
+        if carry:
+            output.write(base64.b64decode(carry))
+        # BytesIO.getvalue 在缓冲区未被导出时直接返回内部 bytes, 不再复制一份
+        blob = output.getvalue()
+        # 没有 data URI 前缀时之前一律当作 PNG; 按文件头识别实际类型
+        info = sniff(blob)
+        return (info.mime_type if info is not None else mime_type, blob)
+
 
-        mime_type = base64_image.split(";")[0].split(":")[1]
-        image_data = base64.b64decode(base64_image.split(",")[1])
-        return (mime_type, image_data)
+class ImageToolMixin:
+    """Shared invoke logic for the OpenAI-compatible text-to-image tools
+
+    Kept as a plain mixin rather than a Tool subclass so that each tool module
+    still defines exactly one Tool subclass for the plugin loader.
+    """
+
+    SUPPORTED_SIZES: list[str] = []
+    SIZE_TABLE: SizeTable
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # 在导入时为每个工具类预先解析尺寸表
+        if cls.SUPPORTED_SIZES:
+            cls.SIZE_TABLE = SizeTable.for_sizes(cls.SUPPORTED_SIZES)
+
+    @staticmethod
+    def _parse_n(value) -> int:
+        try:
+            n = int(float(value))
+        except (TypeError, ValueError):
+            return 1
+        return min(max(n, 1), MAX_IMAGES)
+
+    @staticmethod
+    def _parse_hedge_percentile(value) -> float:
+        """0 (hedging off) unless a percentile between 50 and 99.9 is given"""
+        try:
+            percentile = float(value)
+        except (TypeError, ValueError):
+            return 0.0
+        if percentile <= 0:
+            return 0.0
+        return min(max(percentile, 50.0), 99.9)
+
+    def _generate(
+        self,
+        tool_parameters: dict,
+        model: str,
+        style: str = None,
+        quality: str = None,
+    ) -> Generator[ToolInvokeMessage, None, None]:
+        n = self._parse_n(tool_parameters.get("n", 1))
+        size = tool_parameters.get("size", "1024x1024")
+        generator = ImageGenerator(self.runtime.credentials)
+
+        output_mode = tool_parameters.get("output_mode") or "blob"
+        if output_mode not in OUTPUT_MODES:
+            output_mode = "blob"
+        store = None
+        if output_mode == "url":
+            try:
+                store = TosObjectStore(self.runtime.credentials, storage=self.session.storage)
+            except Exception as e:
+                logger.error(f"TOS unavailable, returning images as blobs: {e}")
+
+        postprocess = PostProcessOptions.from_parameters(tool_parameters)
+        cache = GenerationCache.from_parameters(tool_parameters, self.session)
+        cache_key = None
+        if cache is not None:
+            actual_size = generator.find_closest_size(size, self.SIZE_TABLE)
+            credentials = self.runtime.credentials
+            # 缓存的是后处理后的图片, 不同的后处理选项分开缓存; 本地目录由所有租户共享, 按 base URL 与 API key 区分
+            cache_key = cache.make_key(
+                model,
+                tool_parameters["prompt"],
+                actual_size,
+                style,
+                quality,
+                variant=postprocess.key if postprocess else "",
+                base_url=credentials.get("openai_base_url") or "",
+                api_key=credentials.get("openai_api_key") or "",
+            )
+            cached = cache.get_many(cache_key, n)
+            if cached:
+                for mime_type, blob in cached:
+                    yield self._image_message(mime_type, blob, store)
+                return
+
+        succeeded = 0
+        last_error = None
+        for result in generator.generate_images(
+            prompt=tool_parameters["prompt"],
+            model=model,
+            size=size,
+            supported_sizes=self.SIZE_TABLE,
+            style=style,
+            quality=quality,
+            n=n,
+            hedge_percentile=self._parse_hedge_percentile(tool_parameters.get("hedge_percentile")),
+            postprocess=postprocess,
+        ):
+            if isinstance(result, Exception):
+                last_error = result
+                yield self.create_text_message(f"Image generation failed: {result}")
+                continue
+            mime_type, blob = result
+            yield self._image_message(mime_type, blob, store)
+            if cache is not None:
+                cache.put(cache_key, succeeded, mime_type, blob)
+            succeeded += 1
+
+        if not succeeded and last_error is not None:
+            raise last_error
+
+    def _image_message(self, mime_type: str, blob: bytes, store: TosObjectStore | None) -> ToolInvokeMessage:
+        """An image message: a TOS link when a store is given, otherwise the blob itself
+
+        Objects are keyed by content hash, so an image generated before is not
+        uploaded again. A failed upload falls back to the blob.
+        """
+        if store is not None:
+            object_key = f"{TOS_OUTPUT_PREFIX}/{hashlib.sha256(blob).hexdigest()}.{EXTENSIONS.get(mime_type, 'png')}"
+            try:
+                with span("tos.upload", size=len(blob)):
+                    store.ensure_object(object_key, blob, size=len(blob))
+                return self.create_image_message(store.url(object_key))
+            except Exception as e:
+                logger.error(f"Failed to upload generated image to TOS, returning blob: {e}")
+        return self.create_blob_message(blob=blob, meta={"mime_type": mime_type})
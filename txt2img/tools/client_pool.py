@@ -0,0 +1,123 @@
+import hashlib
+import logging
+import threading
+import time
+from typing import TYPE_CHECKING
+
+from .async_core import io_loop
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+
+logger = logging.getLogger(__name__)
+
+# 连接池参数: 每个客户端的最大连接数 / keep-alive 连接数 / keep-alive 过期秒数
+MAX_CONNECTIONS = 20
+MAX_KEEPALIVE_CONNECTIONS = 10
+KEEPALIVE_EXPIRY = 30.0
+# 客户端空闲超过该秒数后从注册表中移除并关闭
+CLIENT_IDLE_TTL = 300.0
+# 注册表中最多保留的客户端数量
+MAX_CLIENTS = 16
+
+
+def credential_fingerprint(*parts: str | None) -> str:
+    """Return a stable digest of the given credential parts, never the raw secrets"""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update((part or "").encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class _PooledClient:
+    __slots__ = ("client", "base_url", "last_used")
+
+    def __init__(self, client, base_url: str):
+        self.client = client
+        self.base_url = base_url
+        self.last_used = time.monotonic()
+
+
+class ClientRegistry:
+    """Process-wide registry of AsyncOpenAI clients keyed by a credential fingerprint
+
+    Each client owns one httpx connection pool, so repeated calls with the same
+    api key and base URL reuse keep-alive connections instead of paying a new
+    TCP/TLS handshake per invocation. The clients must only be used on the
+    shared I/O loop.
+    """
+
+    def __init__(self, idle_ttl: float = CLIENT_IDLE_TTL, max_clients: int = MAX_CLIENTS):
+        self.idle_ttl = idle_ttl
+        self.max_clients = max_clients
+        self._clients: dict[str, _PooledClient] = {}
+        self._retired: list[_PooledClient] = []
+        self._lock = threading.Lock()
+
+    def get(self, api_key: str, base_url: str) -> "AsyncOpenAI":
+        """Return the cached client for these credentials, creating it if needed"""
+        key = credential_fingerprint(api_key, base_url)
+        with self._lock:
+            stale = self._evict_idle()
+            entry = self._clients.get(key)
+            if entry is None:
+                # 同一个 base_url 换了 key 或超出数量上限时, 旧客户端不会再被取用; 可能仍有请求在途,
+                # 先移入待关闭列表, 空闲超过 idle_ttl 后与过期客户端一起关闭
+                for old_key in [k for k, v in self._clients.items() if v.base_url == base_url]:
+                    self._retired.append(self._clients.pop(old_key))
+                if len(self._clients) >= self.max_clients:
+                    self._retired.append(self._clients.pop(min(self._clients, key=lambda k: self._clients[k].last_used)))
+                entry = _PooledClient(self._create(api_key, base_url), base_url)
+                self._clients[key] = entry
+                logger.info("Created pooled OpenAI client [base_url=%s, clients=%d]", base_url, len(self._clients))
+            entry.last_used = time.monotonic()
+
+        for old in stale:
+            self._close(old)
+        return entry.client
+
+    def clear(self) -> None:
+        """Close and drop every cached client"""
+        with self._lock:
+            stale = list(self._clients.values()) + self._retired
+            self._clients.clear()
+            self._retired = []
+        for old in stale:
+            self._close(old)
+
+    def _evict_idle(self) -> list[_PooledClient]:
+        now = time.monotonic()
+        expired = [k for k, v in self._clients.items() if now - v.last_used > self.idle_ttl]
+        stale = [self._clients.pop(k) for k in expired]
+        stale += [v for v in self._retired if now - v.last_used > self.idle_ttl]
+        self._retired = [v for v in self._retired if now - v.last_used <= self.idle_ttl]
+        return stale
+
+    @staticmethod
+    def _create(api_key: str, base_url: str) -> "AsyncOpenAI":
+        # openai 导入较慢, 推迟到第一次创建客户端时
+        import httpx
+        from openai import AsyncOpenAI
+
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=MAX_CONNECTIONS,
+                max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(120.0, connect=10.0),
+        )
+        # SDK 默认会对 429/5xx/连接错误自动重试 2 次, 绕过限流器的 Retry-After 暂停与路由器的摘除;
+        # 重试交给 EndpointLimiter 与 EndpointRouter, 每个请求只发一次
+        return AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client, max_retries=0)
+
+    @staticmethod
+    def _close(entry: _PooledClient) -> None:
+        # 异步客户端只能在 I/O 循环上关闭, 不等待结果
+        io_loop.submit(entry.client.close()).add_done_callback(
+            lambda f: not f.cancelled() and f.exception() and logger.warning(f"Failed to close pooled AsyncOpenAI client: {f.exception()}")
+        )
+
+
+async_openai_clients = ClientRegistry()
@@ -1,10 +1,10 @@
 from collections.abc import Generator
 from dify_plugin.entities.tool import ToolInvokeMessage
 from dify_plugin import Tool
-from .base_image_tool import ImageGenerator
+from .base_image_tool import ImageToolMixin
 
 
-class DallE3Tool(Tool):
+class DallE3Tool(ImageToolMixin, Tool):
     SUPPORTED_SIZES = ["1024x1024", "1024x1792", "1792x1024"]
 
     def _invoke(
@@ -22,15 +22,4 @@ class DallE3Tool(Tool):
         if style not in {"natural", "vivid"}:
             style = "vivid"
 
-        generator = ImageGenerator(self.runtime.credentials)
-        response = generator.generate_image(
-            prompt=prompt,
-            model="dall-e-3",
-            size=tool_parameters.get("size", "1024x1024"),
-            style=style,
-            quality=quality,
-            supported_sizes=self.SUPPORTED_SIZES,
-        )
-
-        for mime_type, blob in generator.process_response(response):
-            yield self.create_blob_message(blob=blob, meta={"mime_type": mime_type})
+        yield from self._generate(tool_parameters, model="dall-e-3", style=style, quality=quality)
@@ -0,0 +1,220 @@
+import logging
+import random
+import re
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+
+from yarl import URL
+
+from .client_pool import credential_fingerprint
+from .rate_limiter import RateLimitExceeded, get_limiter
+
+logger = logging.getLogger(__name__)
+
+# 延迟与错误率的指数滑动平均系数, 越大越偏重最近的请求
+EWMA_ALPHA = 0.3
+# 错误率对得分的放大倍数: 错误率 50% 的端点被视为慢 (1 + 0.5 * 4) 倍
+ERROR_PENALTY = 4.0
+# 连续失败该次数后暂时摘除端点; 摘除时长从 EJECT_SECONDS 开始每次翻倍, 最多 MAX_EJECT_SECONDS
+EJECT_AFTER_FAILURES = 3
+EJECT_SECONDS = 30.0
+MAX_EJECT_SECONDS = 300.0
+# 这些状态码说明端点本身有问题 (过载或故障), 其余 4xx 是请求的问题, 不计入端点错误
+ENDPOINT_FAILURE_STATUS = {408, 429}
+
+
+class Endpoint:
+    """An OpenAI-compatible base URL with its weight and observed health"""
+
+    def __init__(self, base_url: str, weight: float = 1.0):
+        self.base_url = base_url.rstrip("/")
+        self.weight = weight
+        self.latency: float | None = None
+        self.error_rate = 0.0
+        self.failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+        self.in_flight = 0
+
+    def url(self, path: str) -> str:
+        return str(URL(self.base_url) / path)
+
+    def score(self) -> float:
+        """Expected cost of sending one more request here; lower is better"""
+        latency = self.latency if self.latency is not None else 0.0
+        return latency * (1 + self.in_flight) * (1 + ERROR_PENALTY * self.error_rate) / self.weight
+
+    def snapshot(self) -> dict:
+        return {
+            "base_url": self.base_url,
+            "weight": self.weight,
+            "latency_ms": round(self.latency * 1000, 1) if self.latency is not None else None,
+            "error_rate": round(self.error_rate, 3),
+            "in_flight": self.in_flight,
+            "ejected": self.ejected_until > time.monotonic(),
+        }
+
+
+def parse_base_urls(credentials: dict) -> list[tuple[str, float]]:
+    """Return (base_url, weight) pairs from openai_base_url and the optional openai_base_urls
+
+    openai_base_urls lists extra endpoints separated by commas or newlines,
+    each as ``url`` or ``url|weight``. openai_base_url is always included,
+    with weight 1 unless it is also listed with a weight.
+    """
+    endpoints: dict[str, float] = {}
+    primary = (credentials.get("openai_base_url") or "").strip().rstrip("/")
+    if primary:
+        endpoints[primary] = 1.0
+    for item in re.split(r"[,\n]", credentials.get("openai_base_urls") or ""):
+        item = item.strip()
+        if not item:
+            continue
+        url, _, weight = item.partition("|")
+        url = url.strip().rstrip("/")
+        try:
+            endpoints[url] = float(weight) if weight.strip() else 1.0
+        except ValueError:
+            raise ValueError(f"Invalid weight for OpenAI base URL {url}: {weight.strip()}")
+        if endpoints[url] <= 0:
+            raise ValueError(f"Weight for OpenAI base URL {url} must be positive")
+    return list(endpoints.items())
+
+
+def is_endpoint_failure(error: BaseException) -> bool:
+    """Whether an exception says something about the endpoint rather than the request"""
+    if isinstance(error, RateLimitExceeded):
+        # 客户端排队超时, 请求没有发出
+        return False
+    status = getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+    if status is None:
+        # 连接失败, 超时等没有状态码的错误
+        return True
+    return status >= 500 or status in ENDPOINT_FAILURE_STATUS
+
+
+class EndpointRouter:
+    """Routes each request to the endpoint with the lowest expected latency
+
+    Latency and error rate are tracked per endpoint as EWMAs. An endpoint is
+    scored by its latency, scaled up by the requests already in flight there
+    and by its error rate, and scaled down by its weight. Endpoints with no
+    sample yet score zero, so each is tried once before the data decides.
+    After EJECT_AFTER_FAILURES consecutive failures an endpoint is skipped
+    for an ejection period that doubles each time; when it expires the
+    endpoint gets one trial request and is ejected again if that fails, or
+    starts over with a clean error rate if it succeeds.
+    """
+
+    def __init__(self, endpoints: list[tuple[str, float]]):
+        if not endpoints:
+            raise ValueError("At least one OpenAI base URL is required")
+        self.endpoints = [Endpoint(url, weight) for url, weight in endpoints]
+        self._lock = threading.Lock()
+
+    def choose(self) -> Endpoint:
+        with self._lock:
+            if len(self.endpoints) == 1:
+                return self.endpoints[0]
+            now = time.monotonic()
+            healthy = [e for e in self.endpoints if e.ejected_until <= now]
+            if not healthy:
+                # 全部被摘除时选最早恢复的, 不让请求直接失败
+                return min(self.endpoints, key=lambda e: e.ejected_until)
+            # 上游要求暂停 (Retry-After) 的端点只在没有其他选择时使用
+            healthy = [e for e in healthy if not get_limiter(e.base_url).blocked_for(now)] or healthy
+            for e in healthy:
+                if e.ejections and not e.in_flight:
+                    # 摘除期满的端点先用一个请求试探, 成功后才重新参与打分
+                    return e
+            best = min(e.score() for e in healthy)
+            candidates = [e for e in healthy if e.score() <= best]
+            return random.choices(candidates, weights=[e.weight for e in candidates])[0]
+
+    def record(self, endpoint: Endpoint, latency: float | None, error: BaseException | None = None) -> None:
+        """Feed the outcome of a request; latency is ignored for failures"""
+        failed = error is not None and is_endpoint_failure(error)
+        with self._lock:
+            endpoint.error_rate += EWMA_ALPHA * ((1.0 if failed else 0.0) - endpoint.error_rate)
+            if error is not None and not failed:
+                # 400 / 本地限流等与端点健康无关的错误: 既不算失败, 也不能证明端点已恢复
+                return
+            if not failed:
+                if endpoint.ejections:
+                    # 试探请求成功, 之前的错误率不再代表现状
+                    endpoint.error_rate = 0.0
+                    logger.info("OpenAI endpoint recovered [base_url=%s]", endpoint.base_url)
+                endpoint.failures = 0
+                endpoint.ejections = 0
+                if latency is not None:
+                    endpoint.latency = latency if endpoint.latency is None else endpoint.latency + EWMA_ALPHA * (latency - endpoint.latency)
+                return
+            if endpoint.ejected_until > time.monotonic():
+                # 摘除前已发出的请求陆续失败, 不再延长摘除时间
+                return
+            endpoint.failures += 1
+            if endpoint.failures >= EJECT_AFTER_FAILURES or endpoint.ejections:
+                duration = min(EJECT_SECONDS * 2**endpoint.ejections, MAX_EJECT_SECONDS)
+                endpoint.ejected_until = time.monotonic() + duration
+                endpoint.ejections += 1
+                endpoint.failures = 0
+                if len(self.endpoints) > 1:
+                    logger.warning("Ejected OpenAI endpoint for %.0fs [base_url=%s, error=%s]", duration, endpoint.base_url, error)
+
+    @contextmanager
+    def track(self, endpoint: Endpoint):
+        """Measure a request sent to endpoint and record its outcome"""
+        with self._lock:
+            endpoint.in_flight += 1
+        start = time.monotonic()
+        try:
+            yield endpoint
+        except Exception as e:
+            # 取消 (GeneratorExit / CancelledError) 不是 Exception, 不计入端点错误
+            self.record(endpoint, None, e)
+            raise
+        else:
+            self.record(endpoint, time.monotonic() - start)
+        finally:
+            with self._lock:
+                endpoint.in_flight -= 1
+
+    def track_stream(self, endpoint: Endpoint, chunks) -> Iterator[bytes]:
+        """Pass a streamed response through, recording the time to its first chunk as the latency"""
+        with self._lock:
+            endpoint.in_flight += 1
+        start = time.monotonic()
+        first = True
+        try:
+            for chunk in chunks:
+                if first:
+                    first = False
+                    self.record(endpoint, time.monotonic() - start)
+                yield chunk
+        except Exception as e:
+            self.record(endpoint, None, e)
+            raise
+        finally:
+            with self._lock:
+                endpoint.in_flight -= 1
+
+    def snapshot(self) -> list[dict]:
+        with self._lock:
+            return [e.snapshot() for e in self.endpoints]
+
+
+_routers: dict[str, EndpointRouter] = {}
+_routers_lock = threading.Lock()
+
+
+def get_router(credentials: dict) -> EndpointRouter:
+    """Return the process-wide router for the endpoints in these credentials, so health survives across calls"""
+    endpoints = parse_base_urls(credentials)
+    key = credential_fingerprint(*(f"{url}|{weight}" for url, weight in endpoints))
+    with _routers_lock:
+        router = _routers.get(key)
+        if router is None:
+            router = _routers[key] = EndpointRouter(endpoints)
+        return router
@@ -0,0 +1,170 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import deque
+from collections.abc import Awaitable, Callable
+from typing import TypeVar
+
+from .tracing import span
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# 对冲请求: 调用超过该模型近期延迟的指定百分位仍未返回时, 再发一个相同的请求, 先成功者胜出
+# 每个模型保留的最近成功延迟样本数, 以及开始对冲前至少需要的样本数
+HEDGE_WINDOW = 200
+HEDGE_MIN_SAMPLES = 20
+# 对冲预算: 额外请求不超过开启对冲的请求数的该比例, 空闲后最多积攒 HEDGE_BUDGET_BURST 次
+HEDGE_BUDGET_RATIO = float(os.environ.get("TXT2IMG_HEDGE_BUDGET") or 0.1)
+HEDGE_BUDGET_BURST = 3
+
+
+class LatencyWindow:
+    """The most recent successful latencies of one model"""
+
+    def __init__(self, size: int = HEDGE_WINDOW):
+        self.samples: deque[float] = deque(maxlen=size)
+
+    def record(self, latency: float) -> None:
+        self.samples.append(latency)
+
+    def percentile(self, p: float, min_samples: int = HEDGE_MIN_SAMPLES) -> float | None:
+        """Nearest-rank percentile, None until there are enough samples to trust it"""
+        if len(self.samples) < max(min_samples, 1):
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(int(len(ordered) * p / 100), len(ordered) - 1)]
+
+
+class Hedger:
+    """Sends a duplicate of a slow call and keeps whichever copy succeeds first
+
+    Latency is tracked per key (the model name) from every successful call,
+    hedged or not. A call that opts in with a percentile gets a duplicate
+    once it has been running longer than that percentile of the recent
+    window; the loser is cancelled. Each opted-in call adds HEDGE_BUDGET_RATIO
+    to a budget capped at HEDGE_BUDGET_BURST and each hedge spends one, so
+    duplicates stay near that fraction of traffic even when a backend slows
+    down for everyone.
+    """
+
+    def __init__(self, ratio: float = HEDGE_BUDGET_RATIO, burst: int = HEDGE_BUDGET_BURST):
+        self.ratio = ratio
+        self.burst = max(burst, 1)
+        self.balance = float(self.burst)
+        self.requests = 0
+        self.fired = 0
+        self.won = 0
+        self.denied = 0
+        self._windows: dict[str, LatencyWindow] = {}
+        self._lock = threading.Lock()
+
+    def record(self, key: str, latency: float) -> None:
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None:
+                window = self._windows[key] = LatencyWindow()
+            window.record(latency)
+
+    def delay(self, key: str, percentile: float) -> float | None:
+        """Seconds after which a call for key gets hedged, None if there is no basis yet"""
+        with self._lock:
+            window = self._windows.get(key)
+            return window.percentile(percentile) if window is not None else None
+
+    def _admit(self) -> None:
+        with self._lock:
+            self.requests += 1
+            self.balance = min(self.burst, self.balance + self.ratio)
+
+    def _try_spend(self) -> bool:
+        with self._lock:
+            if self.balance < 1:
+                self.denied += 1
+                return False
+            self.balance -= 1
+            self.fired += 1
+            return True
+
+    async def _timed(self, key: str, attempt: Awaitable[T]) -> T:
+        start = time.monotonic()
+        result = await attempt
+        self.record(key, time.monotonic() - start)
+        return result
+
+    async def run(self, key: str, percentile: float, call: Callable[[bool], Awaitable[T]]) -> T:
+        """Await call(False), hedging it with call(True) if it runs past the percentile
+
+        percentile <= 0 turns hedging off for this call; its latency is still
+        recorded so the window is warm when hedging is turned on.
+        """
+        if percentile <= 0:
+            return await self._timed(key, call(False))
+
+        self._admit()
+        delay = self.delay(key, percentile)
+        start = time.monotonic()
+        primary = asyncio.ensure_future(self._timed(key, call(False)))
+        hedge = None
+        try:
+            if delay is None:
+                return await primary
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+            if done or not self._try_spend():
+                return await primary
+
+            with span("images.hedge", model=key, percentile=percentile, delay=round(delay, 3)) as hedge_span:
+                hedge = asyncio.ensure_future(self._timed(key, call(True)))
+                pending = {primary, hedge}
+                error = None
+                while pending:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        if task.exception() is not None:
+                            # 其中一个失败时继续等另一个
+                            error = error or task.exception()
+                            continue
+                        won = task is hedge
+                        with self._lock:
+                            if won:
+                                self.won += 1
+                            fired, won_total, requests = self.fired, self.won, self.requests
+                        if won:
+                            # 被取消的原请求至少已经耗时这么久, 计入样本以免窗口只剩快的请求
+                            self.record(key, time.monotonic() - start)
+                        hedge_span.set_attribute("winner", "hedge" if won else "primary")
+                        logger.info(
+                            "Hedged request finished [model=%s, after=%.1fs, winner=%s, fired=%d/%d, won=%d]",
+                            key, delay, "hedge" if won else "primary", fired, requests, won_total,
+                        )
+                        return task.result()
+                raise error
+        finally:
+            # 胜出者返回或调用方取消时, 取消仍在进行的请求
+            for task in (primary, hedge):
+                if task is not None and not task.done():
+                    task.add_done_callback(_discard_outcome)
+                    task.cancel()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "fired": self.fired,
+                "won": self.won,
+                "denied": self.denied,
+                "fire_rate": round(self.fired / self.requests, 4) if self.requests else 0.0,
+                "win_rate": round(self.won / self.fired, 4) if self.fired else 0.0,
+            }
+
+
+def _discard_outcome(task: asyncio.Task) -> None:
+    # 读取被取消请求的异常, 避免 "exception was never retrieved" 警告
+    if not task.cancelled():
+        task.exception()
+
+
+hedger = Hedger()
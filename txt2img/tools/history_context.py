@@ -0,0 +1,110 @@
+import hashlib
+import json
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+# 分析提示词中原样保留的最近轮数, 更早的轮次折叠进摘要
+RECENT_TURNS = 3
+# 摘要中保留的指令条数 / 每条指令的最大字符数 / 图片 URL 数量
+SUMMARY_INSTRUCTIONS = 5
+SUMMARY_INSTRUCTION_CHARS = 120
+SUMMARY_IMAGES = 6
+
+IMAGE_LINK_PATTERN = re.compile(r"!\[.*?\]\((https?://[^\s)]+)")
+
+
+def compact_entry(entry: dict) -> dict:
+    """Drop the bulky response text of a history entry, keeping only the images it produced"""
+    return {
+        "dialogue_count": entry.get("dialogue_count", 0),
+        "instruction": entry.get("instruction", ""),
+        "image_urls": entry.get("image_urls", []),
+        "result_image_urls": IMAGE_LINK_PATTERN.findall(entry.get("response_content") or ""),
+    }
+
+
+def _entry_digest(entry: dict) -> str:
+    return hashlib.sha256(json.dumps(entry, ensure_ascii=False, sort_keys=True).encode()).hexdigest()
+
+
+class HistoryContext:
+    """Bounded history context for the s3edit analysis prompt
+
+    The last RECENT_TURNS entries are kept verbatim minus their response
+    text. Older turns are folded into a summary with the total turn count,
+    the latest few instructions and image URLs. The summary is stored next to
+    the history under ``<history key>_summary`` and extended only with the
+    turns that left the recent window since the last call. It is rebuilt when
+    the history was truncated and rewritten below the summarized turns.
+    """
+
+    def __init__(self, storage, history_key: str, recent_turns: int = RECENT_TURNS):
+        self.storage = storage
+        self.key = f"{history_key}_summary"
+        self.recent_turns = recent_turns
+
+    def build(self, entries: list[dict]) -> dict:
+        """Return the JSON-serializable context for the given earlier entries, oldest first"""
+        split = max(len(entries) - self.recent_turns, 0)
+        older, recent = entries[:split], entries[split:]
+        context = {"recent_turns": [compact_entry(entry) for entry in recent]}
+        if older:
+            summary = self._summary(older)
+            context = {
+                "earlier_summary": {
+                    "turns": summary["turns"],
+                    "instructions": summary["instructions"],
+                    "image_urls": summary["image_urls"],
+                },
+                **context,
+            }
+        return context
+
+    def _summary(self, older: list[dict]) -> dict:
+        summary = self._load()
+        start = 0
+        if summary is not None:
+            # 摘要覆盖到 through 这一轮; 该轮内容变化说明历史被截断后重写过, 需要重建
+            start = next((i + 1 for i, entry in enumerate(older) if entry.get("dialogue_count", 0) == summary["through"]), None)
+            if start is None or _entry_digest(older[start - 1]) != summary["digest"]:
+                logger.info("History summary is stale, rebuilding [key=%s]", self.key)
+                summary, start = None, 0
+        if summary is None:
+            summary = {"version": 1, "through": None, "digest": None, "turns": 0, "instructions": [], "image_urls": []}
+        if start == len(older):
+            return summary
+
+        for entry in older[start:]:
+            compact = compact_entry(entry)
+            summary["turns"] += 1
+            instruction = compact["instruction"].strip()
+            if instruction:
+                summary["instructions"].append(instruction[:SUMMARY_INSTRUCTION_CHARS])
+            for url in compact["image_urls"] + compact["result_image_urls"]:
+                if url in summary["image_urls"]:
+                    summary["image_urls"].remove(url)
+                summary["image_urls"].append(url)
+        summary["instructions"] = summary["instructions"][-SUMMARY_INSTRUCTIONS:]
+        summary["image_urls"] = summary["image_urls"][-SUMMARY_IMAGES:]
+        summary["through"] = older[-1].get("dialogue_count", 0)
+        summary["digest"] = _entry_digest(older[-1])
+        self._save(summary)
+        return summary
+
+    def _load(self) -> dict | None:
+        try:
+            raw = self.storage.get(self.key)
+            summary = json.loads(raw.decode()) if raw else None
+        except Exception:
+            return None
+        if not isinstance(summary, dict) or summary.get("version") != 1:
+            return None
+        return summary
+
+    def _save(self, summary: dict) -> None:
+        try:
+            self.storage.set(self.key, json.dumps(summary, ensure_ascii=False).encode())
+        except Exception as e:
+            logger.warning(f"Failed to save history summary: {e}")
@@ -0,0 +1,242 @@
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 每个分段最多保存的记录数, 追加时只重写最后一个分段
+SEGMENT_RECORDS = 8
+# 分段数比容纳当前有效条目所需的多出该值时, 在该次写入中压缩为只包含有效条目的新分段
+COMPACT_SEGMENTS = 4
+# 被覆盖或截断的记录同样计入 session.storage 的 1MB 配额, 超过该字节数时也会压缩
+MAX_SUPERSEDED_BYTES = 64 * 1024
+
+
+class HistoryStore:
+    """Append-only, segmented conversation history in session.storage
+
+    The history is a log of records split into segments of SEGMENT_RECORDS:
+    a ``put`` record adds the entry of a dialogue turn (replacing it when that
+    turn is the last one) and a ``truncate`` record drops every turn after a
+    dialogue_count. A write reads the meta record once and rewrites only the
+    last segment, plus the meta record when a new segment is started, so its
+    cost no longer grows with the conversation. Full segments never change,
+    so a reload within the same invocation only reads the last one again.
+    Replaying the log gives the same entries the previous single JSON array
+    held; such arrays are migrated on the first write.
+    """
+
+    def __init__(self, storage, conversation_id: str, prefix: str = "s3edit_history"):
+        self.storage = storage
+        self.conversation_id = conversation_id
+        self.prefix = prefix
+        self.key = f"{prefix}_{conversation_id}"
+        self.meta = self._empty_meta()
+        self.legacy: list[dict] | None = None
+        self.tail: list[dict] = []
+        self.entries: list[dict] = []
+        self._loaded = False
+        # 已写满的分段 (generation, index) -> 记录; 当前代各分段的字节数
+        self._sealed: dict[tuple[int, int], list[dict]] = {}
+        self._sizes: dict[int, int] = {}
+
+    def load(self) -> list[dict]:
+        """Return the current history entries, oldest first"""
+        self.meta = self._empty_meta()
+        self.legacy = None
+        self.tail = []
+        raw = self._get(self.key)
+        if raw:
+            try:
+                data = json.loads(raw.decode())
+            except (UnicodeDecodeError, json.JSONDecodeError):
+                logger.error("Invalid JSON data in storage, initializing new history")
+                data = None
+            if isinstance(data, list):
+                # 旧版本: 整个历史是一个 JSON 数组
+                self.legacy = data
+            elif isinstance(data, dict) and data.get("version") == 2:
+                self.meta = data
+
+        entries = list(self.legacy or [])
+        generation, last = self.meta["generation"], self.meta["segments"] - 1
+        self._sizes = {}
+        for i in range(self.meta["segments"]):
+            segment = self._sealed.get((generation, i)) if i < last else None
+            if segment is None:
+                segment, self._sizes[i] = self._read_segment(generation, i)
+                if i < last:
+                    self._sealed[(generation, i)] = segment
+            else:
+                self._sizes[i] = self._encoded_size(segment)
+            if i == last:
+                self.tail = segment
+            entries = self._replay(entries, segment)
+
+        self.entries = entries
+        self._loaded = True
+        return self.entries
+
+    def append(self, entry: dict) -> None:
+        """Record the entry of a dialogue turn"""
+        self._write({"op": "put", "entry": entry})
+
+    def truncate(self, dialogue_count) -> None:
+        """Drop every entry after dialogue_count; a no-op when there is none"""
+        if not self._loaded:
+            self.load()
+        if any(entry.get("dialogue_count", 0) > dialogue_count for entry in self.entries):
+            self._write({"op": "truncate", "dialogue_count": dialogue_count})
+
+    @staticmethod
+    def _empty_meta() -> dict:
+        return {"version": 2, "generation": 0, "segments": 0}
+
+    @staticmethod
+    def _replay(entries: list[dict], records: list[dict]) -> list[dict]:
+        for record in records:
+            if record.get("op") == "truncate":
+                limit = record["dialogue_count"]
+                entries = [entry for entry in entries if entry.get("dialogue_count", 0) <= limit]
+            elif record.get("op") == "put":
+                entry = record["entry"]
+                # 只需要判断最后一条history
+                if entries and entries[-1].get("dialogue_count") == entry.get("dialogue_count"):
+                    entries[-1] = entry
+                else:
+                    entries.append(entry)
+        return entries
+
+    def _write(self, record: dict) -> None:
+        # 每次写入只读取一次 meta; 另一个调用在此之后追加或压缩过时先重新加载
+        if not self._loaded or self._meta_changed():
+            self.load()
+        if self.legacy is not None:
+            self._migrate_legacy()
+
+        self._append_record(record)
+        if self._needs_compaction():
+            self._compact()
+
+    def _needs_compaction(self) -> bool:
+        """Whether superseded records take more than COMPACT_SEGMENTS segments or MAX_SUPERSEDED_BYTES"""
+        live_segments = -(-len(self.entries) // SEGMENT_RECORDS)
+        if self.meta["segments"] > live_segments + COMPACT_SEGMENTS:
+            return True
+        stored = sum(self._sizes.values())
+        if stored <= MAX_SUPERSEDED_BYTES:
+            return False
+        live = self._encoded_size([{"op": "put", "entry": entry} for entry in self.entries])
+        return stored - live > MAX_SUPERSEDED_BYTES
+
+    def _append_record(self, record: dict) -> None:
+        new_segment = not self.meta["segments"] or len(self.tail) >= SEGMENT_RECORDS
+        if new_segment:
+            if self.meta["segments"]:
+                self._sealed[(self.meta["generation"], self.meta["segments"] - 1)] = self.tail
+            self.meta["segments"] += 1
+            self.tail = []
+        self.tail.append(record)
+        self._sizes[self.meta["segments"] - 1] = self._set_segment(self.meta["generation"], self.meta["segments"] - 1, self.tail)
+        if new_segment:
+            self.storage.set(self.key, json.dumps(self.meta).encode())
+        self.entries = self._replay(self.entries, [record])
+
+    def _meta_changed(self) -> bool:
+        """Whether another writer or a compaction replaced the meta record since load"""
+        raw = self._get(self.key)
+        if self.legacy is not None:
+            return raw is None or not raw.lstrip().startswith(b"[")
+        try:
+            return (json.loads(raw.decode()) if raw else self._empty_meta()) != self.meta
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            return True
+
+    def _migrate_legacy(self) -> None:
+        """Rewrite a pre-segment JSON array as put records, once"""
+        records = [{"op": "put", "entry": entry} for entry in self.legacy]
+        segments = [records[i : i + SEGMENT_RECORDS] for i in range(0, len(records), SEGMENT_RECORDS)]
+        self._sizes = {}
+        for i, segment in enumerate(segments):
+            self._sizes[i] = self._set_segment(0, i, segment)
+            if i < len(segments) - 1:
+                self._sealed[(0, i)] = segment
+        self.meta = {"version": 2, "generation": 0, "segments": len(segments)}
+        self.tail = segments[-1] if segments else []
+        self.storage.set(self.key, json.dumps(self.meta).encode())
+        self.legacy = None
+
+    def _compact(self) -> None:
+        """Rewrite the live entries as put records under a new generation, then drop the old one
+
+        Runs inside the write that crossed the threshold, while the storage
+        handle is still valid. Segments of the new generation are deleted
+        again when any step fails before the meta record points at them, so
+        a failed compaction leaves no orphans behind.
+        """
+        old = dict(self.meta)
+        generation = old["generation"] + 1
+        records = [{"op": "put", "entry": entry} for entry in self.entries]
+        segments = [records[i : i + SEGMENT_RECORDS] for i in range(0, len(records), SEGMENT_RECORDS)]
+        written = 0
+        sizes = {}
+        try:
+            for i, segment in enumerate(segments):
+                sizes[i] = self._set_segment(generation, i, segment)
+                written = i + 1
+            # 其他调用在此期间追加时放弃本次结果, 下一次写入会再次触发
+            if self._meta_changed() or self._read_segment(old["generation"], old["segments"] - 1)[0] != self.tail:
+                raise RuntimeError("history changed during compaction")
+            meta = {"version": 2, "generation": generation, "segments": len(segments)}
+            self.storage.set(self.key, json.dumps(meta).encode())
+        except Exception as e:
+            logger.error(f"History compaction failed: {e}")
+            for i in range(written):
+                self._delete(self._segment_key(generation, i))
+            return
+
+        self.meta = meta
+        self.tail = segments[-1] if segments else []
+        self._sizes = sizes
+        self._sealed = {(generation, i): segment for i, segment in enumerate(segments[:-1])}
+        for i in range(old["segments"]):
+            self._delete(self._segment_key(old["generation"], i))
+        logger.info("Compacted conversation history [key=%s, entries=%d, segments=%d]", self.key, len(self.entries), len(segments))
+
+    def _segment_key(self, generation: int, index: int) -> str:
+        return f"{self.key}_g{generation}_s{index}"
+
+    def _read_segment(self, generation: int, index: int) -> tuple[list[dict], int]:
+        """Records of a segment and its stored size in bytes"""
+        raw = self._get(self._segment_key(generation, index))
+        if not raw:
+            return [], 0
+        try:
+            return [json.loads(line) for line in raw.decode().splitlines() if line], len(raw)
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            logger.error(f"Invalid history segment {index}, skipping it")
+            return [], len(raw)
+
+    def _set_segment(self, generation: int, index: int, records: list[dict]) -> int:
+        data = self._encode(records)
+        self.storage.set(self._segment_key(generation, index), data)
+        return len(data)
+
+    @staticmethod
+    def _encode(records: list[dict]) -> bytes:
+        return "\n".join(json.dumps(record, ensure_ascii=False) for record in records).encode()
+
+    @classmethod
+    def _encoded_size(cls, records: list[dict]) -> int:
+        return len(cls._encode(records))
+
+    def _get(self, key: str) -> bytes | None:
+        try:
+            return self.storage.get(key)
+        except Exception:
+            return None
+
+    def _delete(self, key: str) -> None:
+        try:
+            self.storage.delete(key)
+        except Exception as e:
+            logger.warning(f"Failed to delete history segment {key}: {e}")
@@ -0,0 +1,158 @@
+import asyncio
+import io
+import logging
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# 可选的后处理: 转码为 WebP/JPEG, 限制最长边, 去除元数据; Pillow 只在开启时导入
+# 编码是 CPU 密集操作, 放在独立的线程池中并限制并发, 同时限制了解码后像素占用的内存
+TRANSCODE_WORKERS = int(os.environ.get("TXT2IMG_TRANSCODE_WORKERS") or min(4, os.cpu_count() or 1))
+_transcode_executor = ThreadPoolExecutor(max_workers=TRANSCODE_WORKERS, thread_name_prefix="image-transcode")
+# 输出格式参数值 -> (Pillow 格式名, MIME 类型)
+OUTPUT_FORMATS = {"webp": ("WEBP", "image/webp"), "jpeg": ("JPEG", "image/jpeg"), "png": ("PNG", "image/png")}
+DEFAULT_QUALITY = 85
+
+
+class PostProcessOptions:
+    """What to do with an image before it is returned; see from_parameters"""
+
+    def __init__(self, output_format: str | None = None, quality: int = DEFAULT_QUALITY, max_side: int = 0):
+        self.output_format = output_format
+        self.quality = quality
+        self.max_side = max_side
+
+    @classmethod
+    def from_parameters(cls, tool_parameters: dict) -> "PostProcessOptions | None":
+        """Options from the output_format/output_quality/max_side parameters, None when nothing is asked for"""
+        output_format = (tool_parameters.get("output_format") or "original").lower()
+        if output_format not in OUTPUT_FORMATS:
+            output_format = None
+        try:
+            quality = min(max(int(float(tool_parameters.get("output_quality") or DEFAULT_QUALITY)), 1), 100)
+        except (TypeError, ValueError):
+            quality = DEFAULT_QUALITY
+        try:
+            max_side = max(int(float(tool_parameters.get("max_side") or 0)), 0)
+        except (TypeError, ValueError):
+            max_side = 0
+        if output_format is None and not max_side:
+            return None
+        return cls(output_format, quality, max_side)
+
+    @property
+    def key(self) -> str:
+        """Stable description of the options, for cache keys"""
+        return f"{self.output_format or 'original'}:{self.quality}:{self.max_side}"
+
+
+class TranscodeStats:
+    """Process-wide byte counters of the post-processing stage"""
+
+    def __init__(self):
+        self.images = 0
+        self.skipped = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._lock = threading.Lock()
+
+    def record(self, bytes_in: int, bytes_out: int | None) -> None:
+        with self._lock:
+            if bytes_out is None:
+                self.skipped += 1
+                return
+            self.images += 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "images": self.images,
+                "skipped": self.skipped,
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+                "bytes_saved": self.bytes_in - self.bytes_out,
+            }
+
+
+transcode_stats = TranscodeStats()
+_pillow_missing_logged = False
+
+
+def transcode(mime_type: str, blob: bytes, options: PostProcessOptions | None) -> tuple[str, bytes]:
+    """Re-encode and/or downscale an image, dropping its metadata
+
+    Whenever options is given the result is a fresh encode without EXIF,
+    ICC or text metadata, even when it is no smaller than the input. The
+    input is returned unchanged only when options is None, Pillow is not
+    installed, or the image cannot be decoded or is animated.
+    """
+    global _pillow_missing_logged
+    if options is None:
+        return mime_type, blob
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        if not _pillow_missing_logged:
+            _pillow_missing_logged = True
+            logger.warning("Pillow is not installed, returning images without post-processing")
+        transcode_stats.record(len(blob), None)
+        return mime_type, blob
+
+    try:
+        with Image.open(io.BytesIO(blob)) as image:
+            if getattr(image, "n_frames", 1) > 1:
+                # 动图转码会丢帧, 原样返回
+                transcode_stats.record(len(blob), None)
+                return mime_type, blob
+            source_format = image.format
+            # 去除 EXIF 前按其方向信息旋转, 避免图片方向改变
+            image = ImageOps.exif_transpose(image)
+            if options.max_side and max(image.size) > options.max_side:
+                image.thumbnail((options.max_side, options.max_side), Image.Resampling.LANCZOS)
+
+            if options.output_format:
+                pil_format, out_mime = OUTPUT_FORMATS[options.output_format]
+            else:
+                # 按实际格式标注, 调用方传入的类型可能只是默认的 image/png
+                pil_format, out_mime = source_format or "PNG", Image.MIME.get(source_format, mime_type)
+            if pil_format == "JPEG" and image.mode != "RGB":
+                # JPEG 不支持透明通道, 铺在白色背景上
+                background = Image.new("RGB", image.size, (255, 255, 255))
+                rgba = image.convert("RGBA")
+                background.paste(rgba, mask=rgba.getchannel("A"))
+                image = background
+            elif pil_format == "WEBP" and image.mode not in ("RGB", "RGBA"):
+                image = image.convert("RGBA" if "A" in image.getbands() or "transparency" in image.info else "RGB")
+
+            output = io.BytesIO()
+            # 不传 exif / icc_profile / pnginfo, 保存结果不含元数据
+            if pil_format in ("JPEG", "WEBP"):
+                image.save(output, format=pil_format, quality=options.quality, optimize=pil_format == "JPEG")
+            else:
+                image.save(output, format=pil_format, optimize=True)
+            result = output.getvalue()
+    except Exception as e:
+        logger.warning(f"Image post-processing failed, returning original: {e}")
+        transcode_stats.record(len(blob), None)
+        return mime_type, blob
+
+    transcode_stats.record(len(blob), len(result))
+    logger.info(
+        "Post-processed image [format=%s, size=%dx%d, in=%d, out=%d, saved_total=%d]",
+        out_mime, image.size[0], image.size[1], len(blob), len(result), transcode_stats.stats()["bytes_saved"],
+    )
+    return out_mime, result
+
+
+def submit_transcode(mime_type: str, blob: bytes, options: PostProcessOptions | None) -> Future:
+    """Run transcode in the shared worker pool and return its Future"""
+    return _transcode_executor.submit(transcode, mime_type, blob, options)
+
+
+async def arun_in_pool(fn, *args):
+    """Await fn(*args) run in the shared worker pool, for CPU-bound image work on the I/O loop"""
+    return await asyncio.wrap_future(_transcode_executor.submit(fn, *args))
@@ -0,0 +1,200 @@
+import os
+
+# 只读取文件头识别图片类型和尺寸, 不复制或解码像素
+# PNG / GIF / WebP 的尺寸都在前 30 字节内; JPEG 需要沿标记段找到 SOF, 最多读取该字节数
+HEAD_BYTES = 32
+JPEG_SCAN_LIMIT = 1024 * 1024
+EXTENSIONS = {"image/png": "png", "image/jpeg": "jpg", "image/webp": "webp", "image/gif": "gif"}
+
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# 带尺寸的 SOF 标记, 不包括 DHT (C4), JPG (C8), DAC (CC)
+_JPEG_SOF = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+# 不带长度字段的 JPEG 标记: TEM 与 RST0-7
+_JPEG_STANDALONE = {0x01, *range(0xD0, 0xD8)}
+
+
+class ImageInfo:
+    """MIME type and, when the header has them, the dimensions of an image"""
+
+    __slots__ = ("mime_type", "width", "height")
+
+    def __init__(self, mime_type: str, width: int | None = None, height: int | None = None):
+        self.mime_type = mime_type
+        self.width = width
+        self.height = height
+
+    @property
+    def extension(self) -> str:
+        return EXTENSIONS[self.mime_type]
+
+    @property
+    def pixels(self) -> int | None:
+        return self.width * self.height if self.width is not None and self.height is not None else None
+
+    def exceeds(self, max_pixels: int | None) -> bool:
+        """Whether the image is known to have more than max_pixels pixels"""
+        return max_pixels is not None and self.pixels is not None and self.pixels > max_pixels
+
+    def __repr__(self) -> str:
+        return f"ImageInfo({self.mime_type}, {self.width}x{self.height})"
+
+
+def sniff(data) -> ImageInfo | None:
+    """Identify a PNG, JPEG, WebP or GIF from the start of a buffer
+
+    data may be bytes, bytearray or a memoryview and is only sliced through
+    a memoryview. None means the bytes are not one of those formats. The
+    dimensions are None when the buffer ends before they appear, which for
+    JPEG means before the SOF segment.
+    """
+    view = memoryview(data)
+    if view.format != "B":
+        view = view.cast("B")
+    info = _sniff_head(view[:HEAD_BYTES])
+    if info is not None and info.mime_type == "image/jpeg":
+        info.width, info.height = _jpeg_size(_BufferReader(view, 2)) or (None, None)
+    return info
+
+
+def sniff_stream(f, scan_limit: int = JPEG_SCAN_LIMIT) -> ImageInfo | None:
+    """sniff() for a binary file object, reading only header bytes
+
+    JPEG segments before the SOF are skipped with seek() when the stream
+    supports it. A seekable stream is returned to its starting position.
+    """
+    start = f.tell() if f.seekable() else None
+    try:
+        head = f.read(HEAD_BYTES)
+        info = _sniff_head(memoryview(head))
+        if info is not None and info.mime_type == "image/jpeg":
+            info.width, info.height = _jpeg_size(_StreamReader(f, head[2:], scan_limit)) or (None, None)
+        return info
+    finally:
+        if start is not None:
+            f.seek(start)
+
+
+def sniff_file(path: str) -> ImageInfo | None:
+    with open(path, "rb") as f:
+        return sniff_stream(f)
+
+
+def _sniff_head(head: memoryview) -> ImageInfo | None:
+    if head[:8] == _PNG_SIGNATURE:
+        if len(head) >= 24 and head[12:16] == b"IHDR":
+            return ImageInfo("image/png", _be(head[16:20]), _be(head[20:24]))
+        return ImageInfo("image/png")
+    if head[:3] == b"\xff\xd8\xff":
+        return ImageInfo("image/jpeg")
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        if len(head) >= 10:
+            return ImageInfo("image/gif", _le(head[6:8]), _le(head[8:10]))
+        return ImageInfo("image/gif")
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return ImageInfo("image/webp", *_webp_size(head))
+    return None
+
+
+def _webp_size(head: memoryview) -> tuple[int | None, int | None]:
+    chunk = bytes(head[12:16])
+    if chunk == b"VP8 " and len(head) >= 30 and head[23:26] == b"\x9d\x01\x2a":
+        # 有损: 关键帧起始码之后是 14 位的宽和高
+        return _le(head[26:28]) & 0x3FFF, _le(head[28:30]) & 0x3FFF
+    if chunk == b"VP8L" and len(head) >= 25 and head[20] == 0x2F:
+        # 无损: 签名之后的 28 位里依次是 (宽-1) 与 (高-1), 各 14 位
+        bits = _le(head[21:25])
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b"VP8X" and len(head) >= 30:
+        # 扩展格式: 画布 (宽-1) 与 (高-1), 各 24 位
+        return _le(head[24:27]) + 1, _le(head[27:30]) + 1
+    return None, None
+
+
+def _jpeg_size(reader) -> tuple[int, int] | None:
+    """Walk the JPEG segments after SOI until a SOF marker, returning (width, height)"""
+    while True:
+        byte = reader.read(1)
+        if not byte:
+            return None
+        if byte[0] != 0xFF:
+            # 标记之间不应有数据, 文件已损坏
+            return None
+        marker = reader.read(1)
+        while marker and marker[0] == 0xFF:
+            # 标记前可以有任意个填充字节 0xFF
+            marker = reader.read(1)
+        if not marker:
+            return None
+        marker = marker[0]
+        if marker in _JPEG_STANDALONE:
+            continue
+        if marker in (0xD9, 0xDA):
+            # EOI / SOS: 之后是压缩数据, SOF 不会再出现
+            return None
+        length = reader.read(2)
+        if len(length) < 2 or _be(length) < 2:
+            return None
+        if marker in _JPEG_SOF:
+            frame = reader.read(5)
+            if len(frame) < 5:
+                return None
+            return _be(frame[3:5]), _be(frame[1:3])
+        if not reader.skip(_be(length) - 2):
+            return None
+
+
+class _BufferReader:
+    __slots__ = ("view", "pos")
+
+    def __init__(self, view: memoryview, pos: int):
+        self.view = view
+        self.pos = pos
+
+    def read(self, n: int) -> memoryview:
+        chunk = self.view[self.pos : self.pos + n]
+        self.pos += len(chunk)
+        return chunk
+
+    def skip(self, n: int) -> bool:
+        self.pos += n
+        return self.pos <= len(self.view)
+
+
+class _StreamReader:
+    """Reads a stream after the bytes already consumed for the head, up to a byte limit"""
+
+    __slots__ = ("f", "pending", "remaining")
+
+    def __init__(self, f, pending: bytes, limit: int):
+        self.f = f
+        self.pending = pending
+        self.remaining = limit - HEAD_BYTES
+
+    def read(self, n: int) -> bytes:
+        chunk, self.pending = self.pending[:n], self.pending[n:]
+        if len(chunk) < n and self.remaining > 0:
+            more = self.f.read(min(n - len(chunk), self.remaining))
+            self.remaining -= len(more)
+            chunk += more
+        return chunk
+
+    def skip(self, n: int) -> bool:
+        buffered = min(n, len(self.pending))
+        self.pending = self.pending[buffered:]
+        n -= buffered
+        if n > self.remaining:
+            return False
+        self.remaining -= n
+        if n and self.f.seekable():
+            self.f.seek(n, os.SEEK_CUR)
+            return True
+        return len(self.f.read(n)) == n if n else True
+
+
+def _be(data) -> int:
+    return int.from_bytes(data, "big")
+
+
+def _le(data) -> int:
+    return int.from_bytes(data, "little")
+
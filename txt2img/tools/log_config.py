@@ -0,0 +1,37 @@
+import logging
+import os
+
+# 日志级别只在 main.py 启动时配置一次, 工具模块自身不再调用 basicConfig:
+# TXT2IMG_LOG_LEVEL 是根级别 (默认 INFO), TXT2IMG_LOG_LEVELS 按 logger 覆盖, 如 "tools.s3edit=DEBUG,httpx=WARNING"
+LOG_LEVEL = os.environ.get("TXT2IMG_LOG_LEVEL") or "INFO"
+LOG_LEVELS = os.environ.get("TXT2IMG_LOG_LEVELS") or ""
+
+_configured = False
+
+
+def _parse_level(name: str) -> int | None:
+    level = getattr(logging, name.strip().upper(), None)
+    return level if isinstance(level, int) else None
+
+
+def configure_logging(level: str = LOG_LEVEL, levels: str = LOG_LEVELS) -> None:
+    """Set up the root handler and per-logger levels; later calls are no-ops"""
+    global _configured
+    if _configured:
+        return
+    _configured = True
+
+    root_level = _parse_level(level)
+    logging.basicConfig(level=root_level if root_level is not None else logging.INFO)
+    if root_level is None:
+        logging.getLogger(__name__).warning("Unknown TXT2IMG_LOG_LEVEL %r, using INFO", level)
+
+    for item in levels.split(","):
+        name, _, value = item.partition("=")
+        if not name.strip():
+            continue
+        logger_level = _parse_level(value)
+        if logger_level is None:
+            logging.getLogger(__name__).warning("Ignoring invalid TXT2IMG_LOG_LEVELS entry %r", item.strip())
+            continue
+        logging.getLogger(name.strip()).setLevel(logger_level)
@@ -0,0 +1,212 @@
+import asyncio
+import email.utils
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger(__name__)
+
+# 每个端点的客户端限流, 插件进程内所有工具共享:
+# 令牌桶速率 (每秒请求数, 0 表示只按上游响应头限流) 与突发容量, 最大并发请求数, 排队等待的最长秒数
+RATE_LIMIT_RPS = float(os.environ.get("TXT2IMG_RATE_LIMIT_RPS") or 0)
+RATE_LIMIT_BURST = int(os.environ.get("TXT2IMG_RATE_LIMIT_BURST") or 10)
+MAX_CONCURRENCY = int(os.environ.get("TXT2IMG_MAX_CONCURRENCY") or 16)
+QUEUE_DEADLINE = float(os.environ.get("TXT2IMG_QUEUE_DEADLINE") or 30)
+# 429 没有 Retry-After 时的默认暂停秒数, 以及上游给出的暂停时间上限
+DEFAULT_RETRY_AFTER = 1.0
+MAX_RETRY_AFTER = 300.0
+# 异步等待并发槽位时的轮询间隔
+ASYNC_POLL_INTERVAL = 0.05
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+class RateLimitExceeded(Exception):
+    """Raised instead of queueing when a slot cannot be had before the queue deadline"""
+
+    def __init__(self, base_url: str, retry_after: float):
+        super().__init__(f"Rate limited by {base_url}, retry after {retry_after:.1f}s")
+        self.base_url = base_url
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """Seconds from a Retry-After header given as delta-seconds or an HTTP date"""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_duration(value: str | None) -> float | None:
+    """Seconds from a reset header: plain seconds or Go-style durations such as '6m0s' or '20ms'"""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in parts)
+
+
+class EndpointLimiter:
+    """Token bucket plus concurrency cap for one backend, fed by its throttling headers
+
+    Requests over the limit queue until a slot frees up rather than failing.
+    A 429/503 with Retry-After, or a rate-limit header reporting zero
+    remaining requests, pauses the endpoint until the reset time. A request
+    that could not start before its queue deadline fails fast with
+    RateLimitExceeded; when the pause alone outlasts the deadline it fails
+    at once instead of holding a slot it will never use.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        rate: float = RATE_LIMIT_RPS,
+        burst: int = RATE_LIMIT_BURST,
+        max_concurrency: int = MAX_CONCURRENCY,
+        deadline: float = QUEUE_DEADLINE,
+    ):
+        self.base_url = base_url
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.max_concurrency = max(max_concurrency, 1)
+        self.deadline = deadline
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.active = 0
+        self.blocked_until = 0.0
+        self.queued = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def blocked_for(self, now: float | None = None) -> float:
+        """Seconds left of an upstream-requested pause"""
+        return max(self.blocked_until - (now if now is not None else time.monotonic()), 0.0)
+
+    def _try_acquire(self, now: float) -> float | None:
+        """Take a slot; return 0 on success, the seconds to wait, or None to wait for a release"""
+        if self.blocked_until > now:
+            return self.blocked_until - now
+        if self.rate > 0:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                return (1 - self.tokens) / self.rate
+        if self.active >= self.max_concurrency:
+            return None
+        if self.rate > 0:
+            self.tokens -= 1
+        self.active += 1
+        return 0.0
+
+    def _reject(self, wait: float | None, remaining: float) -> RateLimitExceeded:
+        self.rejected += 1
+        retry_after = wait if wait is not None else remaining
+        logger.warning("Rate limit queue deadline exceeded [base_url=%s, retry_after=%.1fs, rejected=%d]", self.base_url, retry_after, self.rejected)
+        return RateLimitExceeded(self.base_url, max(retry_after, 0.0))
+
+    async def aacquire(self, deadline: float | None = None) -> None:
+        end = time.monotonic() + (self.deadline if deadline is None else deadline)
+        queued = False
+        try:
+            while True:
+                with self._lock:
+                    now = time.monotonic()
+                    wait = self._try_acquire(now)
+                    if wait == 0:
+                        return
+                    remaining = end - now
+                    if remaining <= 0 or (wait is not None and wait > remaining):
+                        raise self._reject(wait, remaining)
+                    if not queued:
+                        queued = True
+                        self.queued += 1
+                # 释放槽位时无法唤醒协程, 等待并发槽位时按固定间隔重试
+                await asyncio.sleep(min(wait if wait is not None else ASYNC_POLL_INTERVAL, remaining))
+        finally:
+            if queued:
+                with self._lock:
+                    self.queued -= 1
+
+    def release(self) -> None:
+        with self._lock:
+            self.active -= 1
+
+    @asynccontextmanager
+    async def aslot(self, deadline: float | None = None):
+        await self.aacquire(deadline)
+        try:
+            yield self
+        except Exception as e:
+            self.observe_error(e)
+            raise
+        finally:
+            self.release()
+
+    def observe(self, status_code: int, headers) -> None:
+        """Pause the endpoint if a response says it is throttling us"""
+        pause = None
+        if status_code in (429, 503):
+            pause = parse_retry_after(headers.get("retry-after"))
+            if pause is None and status_code == 429:
+                pause = DEFAULT_RETRY_AFTER
+        remaining = headers.get("x-ratelimit-remaining-requests") or headers.get("ratelimit-remaining")
+        try:
+            exhausted = remaining is not None and float(remaining) <= 0
+        except ValueError:
+            exhausted = False
+        if exhausted:
+            reset = parse_duration(headers.get("x-ratelimit-reset-requests") or headers.get("ratelimit-reset"))
+            if reset:
+                pause = max(pause or 0.0, reset)
+        if pause:
+            self.pause(pause)
+
+    def observe_error(self, error: BaseException) -> None:
+        response = getattr(error, "response", None)
+        status_code = getattr(response, "status_code", None)
+        if status_code is not None and getattr(response, "headers", None) is not None:
+            self.observe(status_code, response.headers)
+
+    def pause(self, seconds: float) -> None:
+        seconds = min(seconds, MAX_RETRY_AFTER)
+        with self._lock:
+            until = time.monotonic() + seconds
+            if until > self.blocked_until:
+                self.blocked_until = until
+                logger.warning("Upstream throttling, pausing requests [base_url=%s, seconds=%.1f]", self.base_url, seconds)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"active": self.active, "queued": self.queued, "rejected": self.rejected, "blocked_for": round(self.blocked_for(), 2)}
+
+
+_limiters: dict[str, EndpointLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(base_url: str) -> EndpointLimiter:
+    """Return the process-wide limiter of a backend base URL"""
+    base_url = base_url.rstrip("/")
+    with _limiters_lock:
+        limiter = _limiters.get(base_url)
+        if limiter is None:
+            limiter = _limiters[base_url] = EndpointLimiter(base_url)
+        return limiter
@@ -1,10 +1,10 @@
 from collections.abc import Generator
 from dify_plugin.entities.tool import ToolInvokeMessage
 from dify_plugin import Tool
-from .base_image_tool import ImageGenerator
+from .base_image_tool import ImageToolMixin
 
 
-class RecraftV3Tool(Tool):
+class RecraftV3Tool(ImageToolMixin, Tool):
     SUPPORTED_SIZES = [
         "1024x512",
         "1024x1024",
@@ -28,13 +28,4 @@ class RecraftV3Tool(Tool):
             yield self.create_text_message("Please input prompt")
             return
 
-        generator = ImageGenerator(self.runtime.credentials)
-        response = generator.generate_image(
-            prompt=prompt,
-            model=tool_parameters.get("model", "recraftv3"),
-            size=tool_parameters.get("size", "1024x1024"),
-            supported_sizes=self.SUPPORTED_SIZES,
-        )
-
-        for mime_type, blob in generator.process_response(response):
-            yield self.create_blob_message(blob=blob, meta={"mime_type": mime_type})
+        yield from self._generate(tool_parameters, model=tool_parameters.get("model", "recraftv3"))
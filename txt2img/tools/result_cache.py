@@ -0,0 +1,218 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from .client_pool import credential_fingerprint
+
+logger = logging.getLogger(__name__)
+
+CACHE_MODES = {"off", "storage", "local"}
+DEFAULT_TTL = 86400
+# session.storage 整体上限 1MB (manifest.yaml), 还要给 s3edit 的会话历史留出空间;
+# 单张 1024x1024 的 PNG 通常就超过该值, 插件存储模式需要配合 output_format / max_side 才能缓存到结果
+STORAGE_CAPACITY = 512 * 1024
+LOCAL_CAPACITY = 512 * 1024 * 1024
+LOCAL_CACHE_DIR = os.environ.get("TXT2IMG_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "txt2img-cache")
+
+_INDEX_KEY = "index"
+
+
+class SessionStorageBackend:
+    """Byte store on top of the plugin session.storage"""
+
+    PREFIX = "txt2img_cache_"
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def get(self, key: str) -> bytes | None:
+        try:
+            return self.storage.get(self.PREFIX + key) or None
+        except Exception:
+            return None
+
+    def set(self, key: str, value: bytes) -> None:
+        self.storage.set(self.PREFIX + key, value)
+
+    def delete(self, key: str) -> None:
+        try:
+            self.storage.delete(self.PREFIX + key)
+        except Exception as e:
+            logger.warning(f"Failed to delete cache entry {key}: {e}")
+
+
+class LocalDirBackend:
+    """Byte store on top of a local directory, one file per key"""
+
+    def __init__(self, path: str = LOCAL_CACHE_DIR):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.path, key)
+
+    def get(self, key: str) -> bytes | None:
+        try:
+            with open(self._file(key), "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def set(self, key: str, value: bytes) -> None:
+        # 先写临时文件再原子替换, 避免并发读到半个文件
+        fd, tmp = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, "wb") as f:
+            f.write(value)
+        os.replace(tmp, self._file(key))
+
+    def delete(self, key: str) -> None:
+        try:
+            os.remove(self._file(key))
+        except OSError:
+            pass
+
+
+class GenerationCache:
+    """Content-addressed cache of generated images with TTL and size-aware LRU eviction
+
+    The index (entry sizes, expiry and last access) is kept in the backend
+    next to the blobs, so every plugin worker sharing the backend sees the
+    same entries. It is only rewritten when an entry changes; the hit/miss
+    counters stay in process memory so a miss costs a single read.
+    """
+
+    _lock = threading.Lock()
+    # 进程内的命中统计, 不写入索引
+    _hits = 0
+    _misses = 0
+
+    def __init__(self, backend, capacity: int, ttl: float = DEFAULT_TTL):
+        self.backend = backend
+        self.capacity = capacity
+        self.ttl = ttl
+
+    @classmethod
+    def from_parameters(cls, tool_parameters: dict, session) -> "GenerationCache | None":
+        """Build the cache selected by the cache_mode/cache_ttl tool parameters, or None when off"""
+        mode = tool_parameters.get("cache_mode") or "off"
+        if mode not in CACHE_MODES or mode == "off":
+            return None
+        try:
+            ttl = float(tool_parameters.get("cache_ttl") or DEFAULT_TTL)
+        except (TypeError, ValueError):
+            ttl = DEFAULT_TTL
+        if mode == "storage":
+            return cls(SessionStorageBackend(session.storage), STORAGE_CAPACITY, ttl)
+        return cls(LocalDirBackend(), LOCAL_CAPACITY, ttl)
+
+    @staticmethod
+    def make_key(
+        model: str, prompt: str, size: str, style: str | None, quality: str | None, variant: str = "", *, base_url: str, api_key: str
+    ) -> str:
+        """Digest of the normalized request; size must be the resolved supported size
+
+        variant distinguishes differently post-processed copies of the same
+        request. The base URL and a fingerprint of the API key are part of the
+        key, so tenants sharing the local cache directory never see each
+        other's images.
+        """
+        normalized = [base_url, credential_fingerprint(api_key, base_url), model, " ".join(prompt.split()), size, style or "", quality or ""]
+        if variant:
+            normalized.append(variant)
+        return hashlib.sha256(json.dumps(normalized, ensure_ascii=False).encode()).hexdigest()
+
+    def get_many(self, key: str, n: int) -> list[tuple[str, bytes]] | None:
+        """Return all n cached images for a request, or None if any of them is missing"""
+        with self._lock:
+            index = self._load_index()
+            now = time.time()
+            images = []
+            dropped = False
+            for i in range(n):
+                entry_key = f"{key}-{i}"
+                entry = index["entries"].get(entry_key)
+                if entry is None or entry["expires"] < now:
+                    break
+                blob = self.backend.get(entry_key)
+                if blob is None:
+                    index["entries"].pop(entry_key, None)
+                    dropped = True
+                    break
+                images.append((entry["mime_type"], blob))
+
+            if len(images) == n:
+                GenerationCache._hits += 1
+                # 只有命中 (更新访问时间) 或移除了失效条目时才重写索引
+                for i in range(n):
+                    index["entries"][f"{key}-{i}"]["atime"] = now
+                self._save_index(index)
+            else:
+                GenerationCache._misses += 1
+                images = None
+                if dropped:
+                    self._save_index(index)
+            logger.info("Generation cache %s [hits=%d, misses=%d]", "hit" if images else "miss", GenerationCache._hits, GenerationCache._misses)
+            return images
+
+    def put(self, key: str, i: int, mime_type: str, blob: bytes) -> None:
+        """Store the i-th image of a request, evicting expired and least recently used entries"""
+        size = len(blob)
+        if size > self.capacity:
+            logger.info("Skip caching image larger than cache capacity [size=%d, capacity=%d]", size, self.capacity)
+            return
+        entry_key = f"{key}-{i}"
+        with self._lock:
+            index = self._load_index()
+            entries = index["entries"]
+            entries.pop(entry_key, None)
+            now = time.time()
+            for stale in [k for k, v in entries.items() if v["expires"] < now]:
+                self._evict(entries, stale)
+            used = sum(v["size"] for v in entries.values())
+            for victim in sorted(entries, key=lambda k: entries[k]["atime"]):
+                if used + size <= self.capacity:
+                    break
+                used -= entries[victim]["size"]
+                self._evict(entries, victim)
+            try:
+                self.backend.set(entry_key, blob)
+            except Exception as e:
+                logger.warning(f"Failed to store generation cache entry: {e}")
+            else:
+                entries[entry_key] = {"size": size, "mime_type": mime_type, "expires": now + self.ttl, "atime": now}
+            self._save_index(index)
+
+    def stats(self) -> dict:
+        index = self._load_index()
+        return {
+            "hits": GenerationCache._hits,
+            "misses": GenerationCache._misses,
+            "entries": len(index["entries"]),
+            "bytes": sum(v["size"] for v in index["entries"].values()),
+        }
+
+    def _evict(self, entries: dict, entry_key: str) -> None:
+        entries.pop(entry_key, None)
+        self.backend.delete(entry_key)
+
+    def _load_index(self) -> dict:
+        raw = self.backend.get(_INDEX_KEY)
+        if raw:
+            try:
+                index = json.loads(raw.decode())
+                if isinstance(index, dict) and isinstance(index.get("entries"), dict):
+                    # 旧版本的索引里还有计数字段, 下次保存时去掉
+                    return {"entries": index["entries"]}
+            except (UnicodeDecodeError, json.JSONDecodeError):
+                logger.error("Invalid generation cache index, starting a new one")
+        return {"entries": {}}
+
+    def _save_index(self, index: dict) -> None:
+        try:
+            self.backend.set(_INDEX_KEY, json.dumps(index, separators=(",", ":")).encode())
+        except Exception as e:
+            logger.warning(f"Failed to save generation cache index: {e}")
@@ -1,21 +1,47 @@
 import hashlib
 import json
 import logging
-import random
 import re
+import threading
 import time
+from collections import OrderedDict
 from collections.abc import Generator
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any
 
-import requests
 from dify_plugin import Tool
 from dify_plugin.entities.tool import ToolInvokeMessage
-from tos.exceptions import TosServerError
 from yarl import URL
 
-logging.basicConfig(level=logging.DEBUG)
+from .async_core import apost_json, io_loop, post_json, stream_post
+from .endpoint_router import EndpointRouter, get_router
+from .history_context import HistoryContext
+from .history_store import HistoryStore
+from .image_fetch import DOWNLOAD_TIMEOUT, ContentRejected, DownloadTooLarge, ImagePrefetcher, download_image, image_fetcher
+from .image_postprocess import PostProcessOptions, submit_transcode
+from .image_sniff import sniff, sniff_file
+from .rate_limiter import RateLimitExceeded, get_limiter
+from .sse_stream import CompletionStream, ImageLinkDetector, coalesce
+from .tos_store import TosObjectStore
+from .tracing import span, traced_generator
+
 logger = logging.getLogger(__name__)
 
+# 外部图片下载: 单个资源的默认大小上限
+DEFAULT_MAX_IMAGE_BYTES = 20 * 1024 * 1024
+# 像素数超过该值的图片不转存 (按文件头中的尺寸判断, 不解码)
+MAX_INGEST_PIXELS = 8192 * 8192
+# 并发转存指令中的图片 URL, 超时未完成的 URL 保持原样
+INGEST_MAX_WORKERS = 8
+URL_INGEST_TIMEOUT = 45
+_ingest_executor = ThreadPoolExecutor(max_workers=INGEST_MAX_WORKERS, thread_name_prefix="s3edit-ingest")
+# 历史分析请求在 I/O 循环上与 URL 转存并行执行; 超时时间, 以及按 历史+指令 摘要缓存的解析结果数量
+ANALYSIS_MODEL = "deepseek-v3"
+ANALYSIS_TIMEOUT = 60
+ANALYSIS_CACHE_SIZE = 256
+_analysis_cache: OrderedDict[str, dict] = OrderedDict()
+_analysis_cache_lock = threading.Lock()
+
 
 class S3editTool(Tool):
     @staticmethod
@@ -25,150 +51,160 @@ class S3editTool(Tool):
         return bool(re.search(pattern, url, re.IGNORECASE))
 
     @staticmethod
-    def _generate_headers() -> tuple[dict, dict]:
-        """Generate browser-like headers and cookies for requests"""
-        user_agents = [
-            "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
-            "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.0.0 Safari/537.36 Edg/119.0.0.0",
-            "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/16.5 Safari/605.1.15",
-            "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:120.0) Gecko/20100101 Firefox/120.0",
-            "Mozilla/5.0 (iPhone; CPU iPhone OS 17_0_1 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.0 Mobile/15E148 Safari/604.1",
-        ]
-
-        headers = {
-            "User-Agent": random.choice(user_agents),
-            "Accept": "image/webp,image/apng,image/*,*/*;q=0.8",
-            "Accept-Language": "zh-CN,zh;q=0.9,en;q=0.8",
-            "Accept-Encoding": "gzip, deflate, br",
-            "Connection": "keep-alive",
-            "Sec-Fetch-Dest": "image",
-            "Sec-Fetch-Mode": "no-cors",
-            "Sec-Fetch-Site": "cross-site",
-            "Referer": "https://www.google.com/",
-        }
-
-        cookies = {
-            "appmsglist_action_3941382959": "card",
-            "appmsglist_action_3941382968": "card",
-            "pac_uid": f"{int(time.time())}_f{random.randint(10000, 99999)}",
-            "rewardsn": "",
-            "wxtokenkey": f"{random.randint(100000, 999999)}",
-        }
-
-        return headers, cookies
-
-    @staticmethod
-    def _is_valid_image(content: bytes) -> tuple[bool, str]:
-        """Validate image content using magic numbers, returns (is_valid, detected_type)"""
-        try:
-            if len(content) < 12:
-                return False, ""
-
-            if content.startswith(b"\xff\xd8\xff"):
-                return True, "image/jpeg"
-            if content.startswith(b"\x89PNG\r\n\x1a\n"):
-                return True, "image/png"
-            if content[0:4] == b"RIFF" and content[8:12] == b"WEBP":
-                return True, "image/webp"
-            if content[0:3] == b"GIF":
-                return True, "image/gif"
-            if len(content) > 8 and content[1:4] == b"PNG":
-                return True, "image/png"
-
-        except Exception as e:
-            logger.error(f"Image validation error: {e}")
-
-        return False, ""
-
-    FILE_TYPE_MAP = {"image/jpeg": "jpg", "image/png": "png", "image/webp": "webp", "image/gif": "gif"}
-
-    def save_tos(self, credentials: dict, original_url: str) -> str:
-        """Upload external resource to TOS and return new URL"""
-        import tos
-
+    def _accept_head(head: bytes) -> bool:
+        """Abort a download early unless its first bytes are a supported image that is not known to be oversized"""
+        info = sniff(head)
+        return info is not None and not info.exceeds(MAX_INGEST_PIXELS)
+
+    def save_tos(self, credentials: dict, original_url: str, max_bytes: int = DEFAULT_MAX_IMAGE_BYTES) -> str:
+        """Upload external resource to TOS and return new URL
+
+        The resource goes through the shared image fetcher: the first bytes are
+        sniffed for a valid image type and size, downloads larger than
+        max_bytes are abandoned, and the body is hashed and cached on disk
+        while streaming. JPEG dimensions are read from the stored file's
+        headers once the download is complete.
+        """
         # Download original resource
-        headers, cookies = self._generate_headers()
         try:
             logger.info(f"Downloading external resource from {original_url}")
-            response = requests.get(original_url, headers=headers, cookies=cookies, timeout=60)
-            logger.info(f"Download completed [status={response.status_code}, content_length={len(response.content)}]")
-            response.raise_for_status()
-
-            # Add image validation check
-            if not response.content:
-                logger.error(f"Empty content from {original_url}")
-                return original_url
-
-            # Perform validation
-            is_valid, detected_type = self._is_valid_image(response.content)
-            if not is_valid:
-                logger.error(f"Invalid image content from {original_url} (Detected type: {detected_type})")
-                return original_url
-
+            result = image_fetcher.fetch(original_url, max_bytes=max_bytes, accept=self._accept_head, timeout=60)
+        except DownloadTooLarge as e:
+            logger.error(f"Resource too large from {e}")
+            return original_url
+        except ContentRejected:
+            logger.error(f"Invalid or oversized image content from {original_url}")
+            return original_url
         except Exception as e:
             logger.error(f"Failed to download resource from {original_url}: {e}")
             return original_url  # Return original URL on failure
+        logger.info(f"Download completed [content_length={result.size}, cached={result.from_cache}]")
+
+        # Add image validation check
+        if not result.size:
+            logger.error(f"Empty content from {original_url}")
+            return original_url
+        info = sniff_file(result.path)
+        if info is None:
+            logger.error(f"Invalid image content from {original_url}")
+            return original_url
+        if info.exceeds(MAX_INGEST_PIXELS):
+            logger.error(f"Image too large from {original_url} [size={info.width}x{info.height}, max_pixels={MAX_INGEST_PIXELS}]")
+            return original_url
 
         # Generate content-hashed object key using detected type
-        file_ext = self.FILE_TYPE_MAP.get(detected_type, "png")
-        content_hash = hashlib.sha256(response.content).hexdigest()
-        object_key = f"s3edit/{content_hash}.{file_ext}"
-
-        bucket_name = credentials["VOLCENGINE_TOS_BUCKET_NAME"]
-
-        # Initialize TOS client
-        client = tos.TosClientV2(
-            ak=credentials["VOLCENGINE_TOS_ACCESS_KEY"],
-            sk=credentials["VOLCENGINE_TOS_SECRET_KEY"],
-            endpoint=credentials["VOLCENGINE_TOS_ENDPOINT"],
-            region=credentials["VOLCENGINE_TOS_REGION"],
-        )
+        object_key = f"s3edit/{result.sha256}.{info.extension}"
 
-        # Check if object exists before uploading
         try:
-            logger.info("Checking TOS object existence [bucket=%s, key=%s]", bucket_name, object_key)
-            client.head_object(bucket=bucket_name, key=object_key)
-            logger.info(f"File {content_hash} already exists in TOS bucket")
-        except TosServerError as e:
-            if e.status_code != 404:
-                logger.error(f"TOS check error: {e}")
-            # Upload if not exists
-            client.put_object(bucket=bucket_name, key=object_key, content=response.content)
+            store = TosObjectStore(credentials, storage=self.session.storage)
+            with result.open() as f:
+                store.ensure_object(object_key, f, size=result.size)
         except Exception as e:
             logger.error(f"Failed to save tos: {e}")
             return original_url  # Return original URL on failure
 
         # Return new TOS URL
-        return f"https://{bucket_name}.{str(URL(credentials['VOLCENGINE_TOS_ENDPOINT']).host)}/{object_key}"
+        return store.url(object_key)
+
+    def _ingest_urls(self, credentials: dict, urls: list[str], max_bytes: int) -> list[str]:
+        """Copy non-extension URLs to TOS concurrently, keeping the input order
+
+        A URL whose upload fails or does not finish within URL_INGEST_TIMEOUT
+        keeps its original value.
+        """
+        futures = {
+            url: _ingest_executor.submit(self.save_tos, credentials=credentials, original_url=url, max_bytes=max_bytes)
+            for url in urls
+            if not self._is_image_url(url)
+        }
+        deadline = time.monotonic() + URL_INGEST_TIMEOUT
+        processed = []
+        for url in urls:
+            future = futures.get(url)
+            if future is None:
+                processed.append(url)
+                continue
+            try:
+                processed.append(future.result(timeout=max(deadline - time.monotonic(), 0)))
+            except TimeoutError:
+                future.cancel()
+                logger.error(f"Timed out processing URL {url}, using original URL")
+                processed.append(url)
+            except Exception as e:
+                logger.error(f"Failed to process URL {url}: {e}")
+                processed.append(url)
+        return processed
+
+    @staticmethod
+    def _analysis_key(history: dict, instruction: str, image_urls: list[str]) -> str:
+        """Digest of everything the analysis prompt is built from"""
+        payload = json.dumps([history, instruction, image_urls], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    @staticmethod
+    def _cached_analysis(key: str) -> dict | None:
+        with _analysis_cache_lock:
+            analysis = _analysis_cache.get(key)
+            if analysis is None:
+                return None
+            _analysis_cache.move_to_end(key)
+        return {"target_image_urls": list(analysis["target_image_urls"]), "revised_instruction": analysis["revised_instruction"]}
+
+    @staticmethod
+    def _remember_analysis(key: str, analysis: dict) -> None:
+        with _analysis_cache_lock:
+            _analysis_cache[key] = {"target_image_urls": list(analysis["target_image_urls"]), "revised_instruction": analysis["revised_instruction"]}
+            _analysis_cache.move_to_end(key)
+            while len(_analysis_cache) > ANALYSIS_CACHE_SIZE:
+                _analysis_cache.popitem(last=False)
 
+    @staticmethod
+    async def _request_analysis(router: EndpointRouter, openai_api_key: str, analysis_prompt: str) -> str:
+        """Call the LLM with the analysis prompt and return the raw message content"""
+        endpoint = router.choose()
+        with span("llm.analysis", model=ANALYSIS_MODEL, prompt_chars=len(analysis_prompt), endpoint=endpoint.base_url), router.track(endpoint):
+            response = await apost_json(
+                endpoint.url("v1/chat/completions"),
+                {"Authorization": f"Bearer {openai_api_key}"},
+                {"model": ANALYSIS_MODEL, "messages": [{"role": "user", "content": analysis_prompt}], "temperature": 0.2},
+                timeout=ANALYSIS_TIMEOUT,
+                limiter=get_limiter(endpoint.base_url),
+            )
+        return response["choices"][0]["message"]["content"]
+
+    @traced_generator("s3edit.invoke")
     def _invoke(self, tool_parameters: dict[str, Any]) -> Generator[ToolInvokeMessage]:
         credentials = self.runtime.credentials
         openai_api_key = credentials.get("openai_api_key")
-        openai_base_url = credentials.get("openai_base_url")
-        openai_url = str(URL(openai_base_url) / "v1/chat/completions")
+        router = get_router(credentials)
+        postprocess = PostProcessOptions.from_parameters(tool_parameters)
         conversation_id = tool_parameters.get("conversation_id")
         dialogue_count = tool_parameters.get("dialogue_count", 0)
         image_files = tool_parameters.get("image_files")
         images = [i for i in image_files if i.type == "image"]
+        try:
+            max_image_bytes = int(float(tool_parameters.get("max_image_mb") or 0) * 1024 * 1024) or DEFAULT_MAX_IMAGE_BYTES
+        except (TypeError, ValueError):
+            max_image_bytes = DEFAULT_MAX_IMAGE_BYTES
 
         processed_urls = []
         instruction_to_use = tool_parameters["instruction"]  # Default to new instruction
         is_retry = False
-        storage_key = f"s3edit_history_{conversation_id}"
+        history_store = HistoryStore(self.session.storage, conversation_id)
         # Check for existing history entry for this specific dialogue_count at the beginning
 
         history = []
         try:
-            existing_data = self.session.storage.get(storage_key)
-            if existing_data:
+            with span("history.load", conversation_id=conversation_id):
+                history = history_store.load()
+            if history:
                 logger.info("Loading conversation history [conversation_id=%s, exists=True]", conversation_id)
-                history = json.loads(existing_data.decode())
                 # Only keep entries with dialogue_count <= current count
-                lens = len(history)
-                history = [entry for entry in history if entry.get("dialogue_count", 0) <= dialogue_count]
-                if len(history) < lens:
-                    self.session.storage.set(storage_key, json.dumps(history).encode())
-                logger.info("Loaded conversation history [conversation_id=%s]\n%s", conversation_id, json.dumps(history, indent=2, ensure_ascii=False))
+                history_store.truncate(dialogue_count)
+                history = history_store.entries
+                logger.info("Loaded conversation history [conversation_id=%s, count=%d]", conversation_id, len(history))
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Conversation history [conversation_id=%s]\n%s", conversation_id, json.dumps(history, indent=2, ensure_ascii=False))
 
                 # Check only the last entry after truncation
                 if history and history[-1].get("dialogue_count") == dialogue_count:
@@ -195,25 +231,18 @@ class S3editTool(Tool):
             logger.info("Processing image URLs [total=%d, uploaded=%d, from_instruction=%d]", len(all_image_urls), len(uploaded_image_urls), len(instruction_urls))
             logger.info("Full URL list: %s", [str(URL(url).host) for url in all_image_urls])
 
-            current_processed_urls = []  # Use a temporary list for new processing
-            for url in all_image_urls:
-                if self._is_image_url(url):
-                    current_processed_urls.append(url)
+            # 分析请求只需要原始 URL, 与转存并行发出, 结果中的 URL 之后再映射为转存后的地址
+            earlier_history = [entry for entry in history if entry.get("dialogue_count", 0) < dialogue_count]
+            analysis_key = None
+            analysis = None
+            analysis_future = None
+            if dialogue_count != 0 and earlier_history:
+                history_context = HistoryContext(self.session.storage, history_store.key).build(earlier_history)
+                analysis_key = self._analysis_key(history_context, instruction_text, all_image_urls)
+                analysis = self._cached_analysis(analysis_key)
+                if analysis is not None:
+                    logger.info("Using cached history analysis [key=%s]", analysis_key[:12])
                 else:
-                    try:
-                        new_url = self.save_tos(credentials=credentials, original_url=url)
-                        current_processed_urls.append(new_url)
-                    except Exception as e:
-                        logger.error(f"Failed to process URL {url}: {e}")
-                        continue
-            processed_urls = current_processed_urls  # Assign to the main variable
-            instruction_to_use = instruction_text  # Ensure instruction_to_use reflects the current input
-
-            # Handle case where no new URLs were processed (user modifying previous request)
-            if dialogue_count == 0:  # 新增判断条件
-                instruction_to_use = instruction_text  # 直接使用原始指令
-            else:
-                try:
                     analysis_prompt = f"""
 任务描述: 
 根据用户的聊天历史记录, 分析用户当前的绘画任务是创建新图还是修改之前的结果。
@@ -234,8 +263,8 @@ class S3editTool(Tool):
 
 输入内容: 
 - 当前请求内容:  {instruction_text}
-- 当前用户提供的图片URL: {processed_urls}
-- 相关历史记录:  {json.dumps([entry for entry in history if entry.get("dialogue_count", 0) < dialogue_count], ensure_ascii=False)}
+- 当前用户提供的图片URL: {all_image_urls}
+- 相关历史记录:  {json.dumps(history_context, ensure_ascii=False)}
 
 输出格式: 
 ```json
@@ -245,53 +274,72 @@ class S3editTool(Tool):
 }}
 ```"""
                     logger.info(f"LLM analysis_prompt: {analysis_prompt}")
+                    analysis_future = io_loop.submit(self._request_analysis(router, openai_api_key, analysis_prompt))
 
-                    # 3. Call LLM for analysis
-                    analysis_response = requests.post(
-                        openai_url,
-                        headers={"Authorization": f"Bearer {openai_api_key}"},
-                        json={"model": "deepseek-v3", "messages": [{"role": "user", "content": analysis_prompt}], "temperature": 0.2},
-                    ).json()
-
-                    # 4. Parse and apply results
-                    response_content = analysis_response["choices"][0]["message"]["content"]
-                    logger.info(f"原始分析响应内容:\n{response_content}")
+            with span("urls.ingest", urls=len(all_image_urls)):
+                current_processed_urls = self._ingest_urls(credentials, all_image_urls, max_image_bytes)  # Use a temporary list for new processing
+            processed_urls = current_processed_urls  # Assign to the main variable
+            instruction_to_use = instruction_text  # Ensure instruction_to_use reflects the current input
 
-                    try:
-                        # 尝试提取被```json包裹的JSON内容
-                        json_match = re.search(r"```json\s*({.*?})\s*```", response_content, re.DOTALL)
-                        if json_match:
-                            json_str = json_match.group(1)
-                            analysis = json.loads(json_str)
-                        else:
-                            # 如果没有```json标记, 尝试直接解析整个内容
-                            analysis = json.loads(response_content)
-
-                        logger.info(f"解析后的分析结果: {json.dumps(analysis, ensure_ascii=False)}")
-
-                        # 验证必要字段
-                        required_keys = ["target_image_urls", "revised_instruction"]
-                        if not all(key in analysis for key in required_keys):
-                            missing = [key for key in required_keys if key not in analysis]
-                            logger.error(f"分析结果缺少必要字段: {missing}")
-                            yield self.create_text_message("分析失败: 返回结果字段缺失")
+            # Handle case where no new URLs were processed (user modifying previous request)
+            if dialogue_count == 0:  # 新增判断条件
+                instruction_to_use = instruction_text  # 直接使用原始指令
+            elif not earlier_history:
+                # 没有可以引用的历史记录, 分析结果只会是原始请求和当前图片, 无需调用 LLM
+                logger.info("No earlier history entry, skipping LLM analysis")
+                instruction_to_use = instruction_text
+            else:
+                try:
+                    if analysis is None:
+                        try:
+                            response_content = analysis_future.result(timeout=ANALYSIS_TIMEOUT)
+                        except TimeoutError:
+                            analysis_future.cancel()
+                            raise
+                        logger.info(f"原始分析响应内容:\n{response_content}")
+
+                        try:
+                            # 尝试提取被```json包裹的JSON内容
+                            json_match = re.search(r"```json\s*({.*?})\s*```", response_content, re.DOTALL)
+                            if json_match:
+                                json_str = json_match.group(1)
+                                analysis = json.loads(json_str)
+                            else:
+                                # 如果没有```json标记, 尝试直接解析整个内容
+                                analysis = json.loads(response_content)
+
+                            logger.info(f"解析后的分析结果: {json.dumps(analysis, ensure_ascii=False)}")
+
+                            # 验证必要字段
+                            required_keys = ["target_image_urls", "revised_instruction"]
+                            if not all(key in analysis for key in required_keys):
+                                missing = [key for key in required_keys if key not in analysis]
+                                logger.error(f"分析结果缺少必要字段: {missing}")
+                                yield self.create_text_message("分析失败: 返回结果字段缺失")
+                                return
+
+                            # 确保target_image_urls是列表且不为空
+                            if not isinstance(analysis.get("target_image_urls"), list):
+                                analysis["target_image_urls"] = []
+
+                        except json.JSONDecodeError as e:
+                            logger.error(f"JSON解析失败: {e}\n原始内容: {response_content}")
+                            yield self.create_text_message("分析失败: 服务返回格式异常")
                             return
 
-                        # 确保target_image_urls是列表且不为空
-                        if not isinstance(analysis.get("target_image_urls"), list):
-                            analysis["target_image_urls"] = []
+                        self._remember_analysis(analysis_key, analysis)
 
-                        # 直接使用LLM提取的URLs
-                        processed_urls = analysis["target_image_urls"]
-                        instruction_to_use = analysis["revised_instruction"]
-                        logger.info(f"Updated processed_urls from analysis: {processed_urls}")
-                        logger.info(f"Updated instruction: {instruction_to_use}")
-
-                    except json.JSONDecodeError as e:
-                        logger.error(f"JSON解析失败: {e}\n原始内容: {response_content}")
-                        yield self.create_text_message("分析失败: 服务返回格式异常")
-                        return
+                    # 直接使用LLM提取的URLs, 其中当前请求的原始 URL 换成转存后的地址
+                    url_map = dict(zip(all_image_urls, processed_urls))
+                    processed_urls = [url_map.get(url, url) for url in analysis["target_image_urls"]]
+                    instruction_to_use = analysis["revised_instruction"]
+                    logger.info(f"Updated processed_urls from analysis: {processed_urls}")
+                    logger.info(f"Updated instruction: {instruction_to_use}")
 
+                except RateLimitExceeded as e:
+                    logger.warning(f"History analysis not sent: {e}")
+                    yield self.create_text_message("\n\n当前流量限制, 请稍后再试")
+                    return
                 except Exception as e:
                     logger.error(f"History analysis failed: {e}")
                     yield self.create_text_message("无法定位历史图片, 请明确指定需要修改的图片")
@@ -306,26 +354,10 @@ class S3editTool(Tool):
             }
             logger.info(f"History entry to save: {history_entry}")
             try:
-                existing_data = self.session.storage.get(storage_key)
-                logger.info("Loading conversation history [conversation_id=%s, exists=%s]", conversation_id, existing_data is not None)
-                try:
-                    history = json.loads(existing_data.decode()) if existing_data else []
-                except json.JSONDecodeError:
-                    logger.error("Invalid JSON data in storage, initializing new history")
-                    history = []
-
-                logger.info("History entries loaded [conversation_id=%s, count=%d]", conversation_id, len(history))
-
-                # 只需要判断最后一条history
-                if history and history[-1]["dialogue_count"] == dialogue_count:
-                    logger.info(f"Updating existing entry for dialogue_count {dialogue_count}")
-                    history[-1] = history_entry
-                else:
-                    logger.info(f"Appending new entry for dialogue_count {dialogue_count}")
-                    history.append(history_entry)
-
-                self.session.storage.set(storage_key, json.dumps(history).encode())
-                logger.info("Updated conversation history [conversation_id=%s]\n%s", conversation_id, json.dumps(history, indent=2, ensure_ascii=False))
+                with span("history.save"):
+                    history_store.append(history_entry)
+                history = history_store.entries
+                logger.info("Updated conversation history [conversation_id=%s, count=%d]", conversation_id, len(history))
             except Exception as e:
                 logger.error(f"Failed to save initial conversation history: {e}")
 
@@ -353,41 +385,33 @@ class S3editTool(Tool):
 
         # --- API Call Section ---
         try:
-            # 发送API请求
+            # 发送API请求, 由路由器选择当前最快的可用端点
+            endpoint = router.choose()
+            openai_url = endpoint.url("v1/chat/completions")
+            limiter = get_limiter(endpoint.base_url)
             openai_payload = {"model": model, "messages": messages, "stream": stream}
             headers = {"Authorization": f"Bearer {openai_api_key}", "Content-Type": "application/json"}
-            logger.info({"url": openai_url, "headers": headers, "payload": openai_payload, "processed_urls": processed_urls})
-            response = requests.post(openai_url, headers=headers, json=openai_payload, timeout=60, stream=stream)
-            response.raise_for_status()
-
-            content = ""
-            if stream:
-                logger.info("Starting to process streaming response")
-                # 如果是流式响应, 需要拼接内容
-                for line in response.iter_lines():
-                    if line:
-                        line_text = line.decode("utf-8")
-                        logger.info("Received streaming chunk: %s", line_text[:100])  # 记录前100字符
-                    if line:
-                        # 移除"data: "前缀并解析JSON
-                        line_text = line.decode("utf-8")
-                        if line_text.startswith("data: "):
-                            json_str = line_text[6:]
-                            if json_str.strip() == "[DONE]":
-                                break
-                            try:
-                                chunk = json.loads(json_str)
-                                if chunk.get("choices") and chunk["choices"][0].get("delta", {}).get("content"):
-                                    chunk_content = chunk["choices"][0]["delta"]["content"]
-                                    content += chunk_content
-                                    yield self.create_text_message(chunk_content)
-                            except json.JSONDecodeError:
-                                logger.warning(f"无法解析JSON: {json_str}")
+            logger.info({"url": openai_url, "payload": openai_payload, "processed_urls": processed_urls})
+            # 流式返回中一出现图片链接就开始后台下载
+            prefetcher = ImagePrefetcher(should_fetch=lambda url: not self._is_image_url(url))
+            with span("chat.completion", model=model, stream=stream, endpoint=endpoint.base_url):
+                content = ""
+                if stream:
+                    logger.info("Starting to process streaming response")
+                    # 如果是流式响应, 需要拼接内容
+                    links = ImageLinkDetector(prefetcher.offer)
+                    completion = CompletionStream(router.track_stream(endpoint, stream_post(openai_url, headers, openai_payload, timeout=60, limiter=limiter)), on_delta=links.feed)
+                    for text in coalesce(completion.deltas()):
+                        yield self.create_text_message(text)
+                    content = completion.text
+                    logger.info("Stream finished [events=%d, chars=%d]", completion.events, len(content))
 
-            else:
-                logger.info("Processing non-streaming response")
-                content = response.json()["choices"][0]["message"]["content"]
-                yield self.create_text_message(content)
+                else:
+                    logger.info("Processing non-streaming response")
+                    with router.track(endpoint):
+                        response = post_json(openai_url, headers, openai_payload, timeout=60, limiter=limiter)
+                    content = response["choices"][0]["message"]["content"]
+                    yield self.create_text_message(content)
 
             logger.info("Full response content: %s", content)
 
@@ -400,20 +424,17 @@ class S3editTool(Tool):
             }
             logger.info(f"Final history entry with response: {history_entry_with_response}")
             try:
-                # 只需要判断最后一条history
-                if history and history[-1]["dialogue_count"] == dialogue_count:
-                    logger.info(f"Updating existing entry for dialogue_count {dialogue_count} with response")
-                    history[-1] = history_entry_with_response
-                else:
-                    logger.info(f"Appending new entry for dialogue_count {dialogue_count} with response")
-                    history.append(history_entry_with_response)
-
-                self.session.storage.set(storage_key, json.dumps(history).encode())
-                logger.info("Updated conversation history with response [conversation_id=%s]\n%s", conversation_id, json.dumps(history, indent=2, ensure_ascii=False))
+                with span("history.save"):
+                    history_store.append(history_entry_with_response)
+                history = history_store.entries
+                logger.info("Updated conversation history with response [conversation_id=%s, count=%d]", conversation_id, len(history))
             except Exception as e:
                 logger.error(f"Failed to update conversation history with response: {e}")
 
             image_urls = re.findall(r"!\[.*?\]\((https?://[^\s)]+)", content)
+            # 优先使用流式过程中已开始的下载, 其余预取不再需要
+            prefetched = prefetcher.take(image_urls[-1]) if image_urls else None
+            prefetcher.close()
             if image_urls:
                 logger.info("Detected %d image URLs in response", len(image_urls))
                 last_url = image_urls[-1]
@@ -421,13 +442,16 @@ class S3editTool(Tool):
                 if not self._is_image_url(last_url):
                     logger.info(f"unknown image url: {last_url}")
                     try:
-                        headers, cookies = self._generate_headers()
-                        # Download image and convert to base64
-                        response = requests.get(last_url, headers=headers, cookies=cookies, timeout=30)
-                        response.raise_for_status()
-                        content_type = response.headers.get("Content-Type", "image/png")
-
-                        yield self.create_blob_message(blob=response.content, meta={"mime_type": content_type})
+                        with span("image.download", prefetched=prefetched is not None):
+                            if prefetched is not None:
+                                content_type, blob = prefetched.result(timeout=DOWNLOAD_TIMEOUT)
+                            else:
+                                content_type, blob = download_image(last_url)
+                        if postprocess is not None:
+                            with span("image.postprocess", size=len(blob)):
+                                content_type, blob = submit_transcode(content_type, blob, postprocess).result()
+
+                        yield self.create_blob_message(blob=blob, meta={"mime_type": content_type})
                     except Exception as e:
                         logger.error(f"Failed to process image URL: {e}")
                         yield self.create_text_message("\n\n图片处理失败, 请尝试重新生成")
@@ -437,5 +461,9 @@ class S3editTool(Tool):
 
             yield self.create_text_message("\n\n当前流量限制, 请稍后再试")
 
+        except RateLimitExceeded as e:
+            # 排队超时, 上游仍在限流
+            logger.warning(f"Request not sent: {e}")
+            yield self.create_text_message("\n\n当前流量限制, 请稍后再试")
         except Exception as e:
             raise BaseException(f"API Error: {str(e)}")
@@ -1,17 +1,19 @@
-import json
 import logging
-import random
 import re
-import time
 from collections.abc import Generator
 from typing import Any
 
-import requests
 from dify_plugin import Tool
 from dify_plugin.entities.tool import ToolInvokeMessage
-from yarl import URL
 
-logging.basicConfig(level=logging.INFO)
+from .async_core import post_json, stream_post
+from .endpoint_router import get_router
+from .image_fetch import DOWNLOAD_TIMEOUT, ImagePrefetcher, download_image
+from .image_postprocess import PostProcessOptions, submit_transcode
+from .rate_limiter import RateLimitExceeded, get_limiter
+from .sse_stream import CompletionStream, ImageLinkDetector, coalesce
+from .tracing import span, traced_generator
+
 logger = logging.getLogger(__name__)
 
 
@@ -22,11 +24,12 @@ class SeededitTool(Tool):
         pattern = r"\.(png|jpe?g)(?=[^/]*$)"  # 匹配最后一个路径段的图片扩展名
         return bool(re.search(pattern, url, re.IGNORECASE))
 
+    @traced_generator("seededit.invoke")
     def _invoke(self, tool_parameters: dict[str, Any]) -> Generator[ToolInvokeMessage]:
         credentials = self.runtime.credentials
         openai_api_key = credentials.get("openai_api_key")
-        openai_base_url = credentials.get("openai_base_url")
-        openai_url = str(URL(openai_base_url) / "v1/chat/completions")
+        router = get_router(credentials)
+        postprocess = PostProcessOptions.from_parameters(tool_parameters)
 
         image_files = tool_parameters.get("image_files")
         images = [i for i in image_files if i.type == "image"]
@@ -62,83 +65,54 @@ class SeededitTool(Tool):
             url_prefix = " ".join(all_image_urls)
             messages[0]["content"] = f"{url_prefix} {instruction_text}".strip()
         try:
-            # 发送API请求
+            # 发送API请求, 由路由器选择当前最快的可用端点
+            endpoint = router.choose()
+            openai_url = endpoint.url("v1/chat/completions")
+            limiter = get_limiter(endpoint.base_url)
             openai_payload = {"model": model, "messages": messages, "stream": stream}
             headers = {"Authorization": f"Bearer {openai_api_key}", "Content-Type": "application/json"}
-            logger.info({"url": openai_url, "headers": headers, "payload": openai_payload})
-            response = requests.post(openai_url, headers=headers, json=openai_payload, timeout=60, stream=stream)
-            response.raise_for_status()
-
-            content = ""
-            if stream:
-                # 如果是流式响应，需要拼接内容
-                for line in response.iter_lines():
-                    logger.info(line)
-                    if line:
-                        # 移除"data: "前缀并解析JSON
-                        line_text = line.decode("utf-8")
-                        if line_text.startswith("data: "):
-                            json_str = line_text[6:]
-                            if json_str.strip() == "[DONE]":
-                                break
-                            try:
-                                chunk = json.loads(json_str)
-                                if chunk.get("choices") and chunk["choices"][0].get("delta", {}).get("content"):
-                                    chunk_content = chunk["choices"][0]["delta"]["content"]
-                                    content += chunk_content
-                                    yield self.create_text_message(chunk_content)
-                            except json.JSONDecodeError:
-                                logger.warning(f"无法解析JSON: {json_str}")
-
-            else:
-                # 非流式响应直接获取内容
-                content = response.json()["choices"][0]["message"]["content"]
-                yield self.create_text_message(content)
+            logger.info({"url": openai_url, "payload": openai_payload})
+            # 流式返回中一出现图片链接就开始后台下载
+            prefetcher = ImagePrefetcher(should_fetch=lambda url: not self._is_image_url(url))
+            with span("chat.completion", model=model, stream=stream, endpoint=endpoint.base_url):
+                content = ""
+                if stream:
+                    # 如果是流式响应，需要拼接内容
+                    links = ImageLinkDetector(prefetcher.offer)
+                    completion = CompletionStream(router.track_stream(endpoint, stream_post(openai_url, headers, openai_payload, timeout=60, limiter=limiter)), on_delta=links.feed)
+                    for text in coalesce(completion.deltas()):
+                        yield self.create_text_message(text)
+                    content = completion.text
+                    logger.info("Stream finished [events=%d, chars=%d]", completion.events, len(content))
+
+                else:
+                    # 非流式响应直接获取内容
+                    with router.track(endpoint):
+                        response = post_json(openai_url, headers, openai_payload, timeout=60, limiter=limiter)
+                    content = response["choices"][0]["message"]["content"]
+                    yield self.create_text_message(content)
 
             logger.info(content)
             image_urls = re.findall(r"!\[.*?\]\((https?://[^\s)]+)", content)
+            # 优先使用流式过程中已开始的下载, 其余预取不再需要
+            prefetched = prefetcher.take(image_urls[-1]) if image_urls else None
+            prefetcher.close()
             if image_urls:
                 last_url = image_urls[-1]
 
                 if not self._is_image_url(last_url):
                     logger.info(f"unknown image url: {last_url}")
                     try:
-                        # 随机选择一个User-Agent，模拟不同浏览器
-                        user_agents = [
-                            "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
-                            "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.0.0 Safari/537.36 Edg/119.0.0.0",
-                            "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/16.5 Safari/605.1.15",
-                            "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:120.0) Gecko/20100101 Firefox/120.0",
-                            "Mozilla/5.0 (iPhone; CPU iPhone OS 17_0_1 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.0 Mobile/15E148 Safari/604.1",
-                        ]
-                        selected_ua = random.choice(user_agents)
-
-                        # 构建更真实的请求头
-                        headers = {
-                            "User-Agent": selected_ua,
-                            "Accept": "image/webp,image/apng,image/*,*/*;q=0.8",
-                            "Accept-Language": "zh-CN,zh;q=0.9,en;q=0.8",
-                            "Accept-Encoding": "gzip, deflate, br",
-                            "Connection": "keep-alive",
-                            "Sec-Fetch-Dest": "image",
-                            "Sec-Fetch-Mode": "no-cors",
-                            "Sec-Fetch-Site": "cross-site",
-                            "Referer": "https://www.google.com/",
-                        }
-                        # 添加必要的Cookie参数，减少被检测的可能性
-                        cookies = {
-                            "appmsglist_action_3941382959": "card",  # 一些随机的Cookie值
-                            "appmsglist_action_3941382968": "card",
-                            "pac_uid": f"{int(time.time())}_f{random.randint(10000, 99999)}",
-                            "rewardsn": "",
-                            "wxtokenkey": f"{random.randint(100000, 999999)}",
-                        }
-                        # Download image and convert to base64
-                        response = requests.get(last_url, headers=headers, cookies=cookies, timeout=30)
-                        response.raise_for_status()
-                        content_type = response.headers.get("Content-Type", "image/png")
-
-                        yield self.create_blob_message(blob=response.content, meta={"mime_type": content_type})
+                        with span("image.download", prefetched=prefetched is not None):
+                            if prefetched is not None:
+                                content_type, blob = prefetched.result(timeout=DOWNLOAD_TIMEOUT)
+                            else:
+                                content_type, blob = download_image(last_url)
+                        if postprocess is not None:
+                            with span("image.postprocess", size=len(blob)):
+                                content_type, blob = submit_transcode(content_type, blob, postprocess).result()
+
+                        yield self.create_blob_message(blob=blob, meta={"mime_type": content_type})
                     except Exception as e:
                         logger.error(f"Failed to process image URL: {e}")
                         yield self.create_text_message("图片处理失败，请尝试重新生成")
@@ -148,5 +122,9 @@ class SeededitTool(Tool):
                 return
             yield self.create_text_message("当前流量限制，请稍后再试")
 
+        except RateLimitExceeded as e:
+            # 排队超时, 上游仍在限流
+            logger.warning(f"Request not sent: {e}")
+            yield self.create_text_message("当前流量限制，请稍后再试")
         except Exception as e:
             raise BaseException(f"API Error: {str(e)}")
@@ -0,0 +1,222 @@
+import contextvars
+import json
+import logging
+import queue
+import re
+import threading
+import time
+from collections.abc import Callable, Iterable, Iterator
+
+logger = logging.getLogger(__name__)
+
+# 合并流式增量: 首个增量立即发送, 之后累积到足够字符数或超过时间窗口再发送一条消息
+COALESCE_MIN_CHARS = 64
+COALESCE_MAX_INTERVAL = 0.25
+# 流式内容中已闭合的 markdown 图片链接
+IMAGE_LINK_PATTERN = re.compile(r"!\[[^\n]*?\]\((https?://[^\s)]+)\)")
+# 未找到链接时保留的尾部文本长度, 足以容纳被拆分在多个增量中的一个链接
+LINK_TAIL_CHARS = 4096
+
+
+class SSEParser:
+    """Incremental parser for server-sent events fed with arbitrary byte chunks
+
+    Lines may be split across chunks and an event may carry several ``data:``
+    lines, which are joined with newlines as the SSE spec requires. Events end
+    only at a blank line, or when the stream ends.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._data: list[str] = []
+
+    def feed(self, chunk: bytes) -> Iterator[str]:
+        """Consume a chunk and yield the data payload of every completed event"""
+        self._buffer += chunk
+        start = 0
+        while True:
+            end = self._buffer.find(b"\n", start)
+            if end == -1:
+                break
+            line = self._buffer[start:end].rstrip(b"\r").decode("utf-8", errors="replace")
+            start = end + 1
+            yield from self._line(line)
+        del self._buffer[:start]
+
+    def close(self) -> Iterator[str]:
+        """Flush whatever is left once the stream has ended"""
+        if self._buffer:
+            line = self._buffer.decode("utf-8", errors="replace").rstrip("\r")
+            self._buffer.clear()
+            yield from self._line(line)
+        if self._data:
+            yield self._dispatch()
+
+    def _line(self, line: str) -> Iterator[str]:
+        if not line:
+            if self._data:
+                yield self._dispatch()
+            return
+        if line.startswith(":"):
+            # 注释行, 常用作心跳
+            return
+        field, _, value = line.partition(":")
+        if field != "data":
+            return
+        if value.startswith(" "):
+            value = value[1:]
+        self._data.append(value)
+
+    def _dispatch(self) -> str:
+        data = "\n".join(self._data)
+        self._data = []
+        return data
+
+
+class CompletionStream:
+    """Reads an OpenAI-compatible chat completion stream and collects its text"""
+
+    def __init__(self, chunks: Iterable[bytes], on_delta: Callable[[str], None] | None = None):
+        self.chunks = chunks
+        self.on_delta = on_delta
+        self.events = 0
+        self._parts: list[str] = []
+
+    @property
+    def text(self) -> str:
+        return "".join(self._parts)
+
+    def deltas(self) -> Iterator[str]:
+        """Yield each non-empty content delta until [DONE] or the end of the stream"""
+        parser = SSEParser()
+        for chunk in self.chunks:
+            if not chunk:
+                continue
+            for data in parser.feed(chunk):
+                if data.strip() == "[DONE]":
+                    return
+                delta = self._delta(data)
+                if delta:
+                    yield delta
+        for data in parser.close():
+            if data.strip() == "[DONE]":
+                return
+            delta = self._delta(data)
+            if delta:
+                yield delta
+
+    def _delta(self, data: str) -> str | None:
+        self.events += 1
+        try:
+            chunk = json.loads(data)
+        except json.JSONDecodeError:
+            logger.warning(f"无法解析JSON: {data[:200]}")
+            return None
+        choices = chunk.get("choices") if isinstance(chunk, dict) else None
+        if not choices:
+            return None
+        content = (choices[0].get("delta") or {}).get("content")
+        if content:
+            self._parts.append(content)
+            if self.on_delta is not None:
+                self.on_delta(content)
+        return content
+
+
+class ImageLinkDetector:
+    """Reports markdown image links as soon as their closing parenthesis arrives in a stream"""
+
+    def __init__(self, on_link: Callable[[str], None]):
+        self.on_link = on_link
+        self._tail = ""
+
+    def feed(self, delta: str) -> None:
+        self._tail += delta
+        if ")" not in delta:
+            return
+        end = 0
+        for match in IMAGE_LINK_PATTERN.finditer(self._tail):
+            self.on_link(match.group(1))
+            end = match.end()
+        if end:
+            self._tail = self._tail[end:]
+        elif len(self._tail) > LINK_TAIL_CHARS:
+            self._tail = self._tail[-LINK_TAIL_CHARS:]
+
+
+# 读线程在源结束时放入的哨兵
+_END = object()
+
+
+def coalesce(deltas: Iterable[str], min_chars: int = COALESCE_MIN_CHARS, max_interval: float = COALESCE_MAX_INTERVAL) -> Iterator[str]:
+    """Merge small deltas into larger messages without delaying the first one
+
+    Buffered text is flushed once it reaches min_chars, once max_interval
+    seconds have passed since the previous flush, and at the end. The source
+    is read on a helper thread so the window also runs out while the upstream
+    is silent; closing the returned generator stops that thread after its
+    current read.
+    """
+    ready: queue.Queue = queue.Queue()
+    stop = threading.Event()
+    # 复制上下文, 读线程中打开的 span 仍挂在调用方的 trace 下
+    reader = threading.Thread(target=contextvars.copy_context().run, args=(_pump, deltas, ready, stop), name="sse-coalesce", daemon=True)
+    reader.start()
+    pending: list[str] = []
+    pending_chars = 0
+    first = True
+    last_flush = time.monotonic()
+    try:
+        while True:
+            timeout = max(last_flush + max_interval - time.monotonic(), 0.0) if pending else None
+            try:
+                delta, error = ready.get(timeout=timeout)
+            except queue.Empty:
+                # 时间窗口到期而上游没有新增量, 先发出已缓冲的内容
+                yield "".join(pending)
+                pending = []
+                pending_chars = 0
+                last_flush = time.monotonic()
+                continue
+            if error is not None:
+                raise error
+            if delta is _END:
+                break
+            if first:
+                first = False
+                last_flush = time.monotonic()
+                yield delta
+                continue
+            pending.append(delta)
+            pending_chars += len(delta)
+            now = time.monotonic()
+            if pending_chars >= min_chars or now - last_flush >= max_interval:
+                yield "".join(pending)
+                pending = []
+                pending_chars = 0
+                last_flush = now
+        if pending:
+            yield "".join(pending)
+    finally:
+        stop.set()
+
+
+def _pump(deltas: Iterable[str], ready: queue.Queue, stop: threading.Event) -> None:
+    """Move deltas onto the queue until the source ends or coalesce is closed"""
+    source = iter(deltas)
+    try:
+        for delta in source:
+            ready.put((delta, None))
+            if stop.is_set():
+                break
+        ready.put((_END, None))
+    except BaseException as e:
+        ready.put((None, e))
+    finally:
+        # 生成器只能在读取它的线程里关闭; 提前结束时由此释放上游连接
+        close = getattr(source, "close", None)
+        if close is not None:
+            try:
+                close()
+            except Exception as e:
+                logger.warning(f"Failed to close coalesced stream: {e}")
@@ -0,0 +1,189 @@
+import json
+import logging
+import threading
+from collections import OrderedDict
+from typing import TYPE_CHECKING
+
+from yarl import URL
+
+from .client_pool import credential_fingerprint
+
+if TYPE_CHECKING:
+    import tos
+
+logger = logging.getLogger(__name__)
+
+# 内存中每个桶最多记住的已上传对象数量
+MAX_KNOWN_OBJECTS = 4096
+# 持久化到 session.storage 的对象数量上限 (约 80 字节/条, 与会话历史共享 1MB 配额)
+MAX_PERSISTED_OBJECTS = 512
+INDEX_STORAGE_KEY = "tos_known_objects"
+# 超过该大小的内容改用分片上传, 每片从文件对象中按需读取
+MULTIPART_THRESHOLD = 16 * 1024 * 1024
+MULTIPART_PART_SIZE = 8 * 1024 * 1024
+
+_clients: dict[str, "tos.TosClientV2"] = {}
+_clients_lock = threading.Lock()
+
+
+def get_tos_client(credentials: dict) -> "tos.TosClientV2":
+    """Return a TOS client shared by every call with the same credential set"""
+    key = credential_fingerprint(
+        credentials["VOLCENGINE_TOS_ACCESS_KEY"],
+        credentials["VOLCENGINE_TOS_SECRET_KEY"],
+        credentials["VOLCENGINE_TOS_ENDPOINT"],
+        credentials["VOLCENGINE_TOS_REGION"],
+    )
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            # TOS SDK 只在转存图片 (s3edit) 或以链接返回生成的图片 (output_mode=url) 时用到, 首次使用时再导入
+            import tos
+
+            client = _clients[key] = tos.TosClientV2(
+                ak=credentials["VOLCENGINE_TOS_ACCESS_KEY"],
+                sk=credentials["VOLCENGINE_TOS_SECRET_KEY"],
+                endpoint=credentials["VOLCENGINE_TOS_ENDPOINT"],
+                region=credentials["VOLCENGINE_TOS_REGION"],
+            )
+        return client
+
+
+class KnownObjectIndex:
+    """Object keys known to exist in a bucket, so their head_object check can be skipped
+
+    Keys are content hashes, so an entry never goes stale unless the object is
+    deleted out of band. Misses are always verified against TOS.
+    """
+
+    def __init__(self, max_size: int = MAX_KNOWN_OBJECTS):
+        self.max_size = max_size
+        self._buckets: dict[str, OrderedDict] = {}
+        self._loaded: set[str] = set()
+        self._lock = threading.Lock()
+        self.saved_requests = 0
+
+    def contains(self, bucket_id: str, object_key: str) -> bool:
+        with self._lock:
+            keys = self._buckets.get(bucket_id)
+            if keys is None or object_key not in keys:
+                return False
+            keys.move_to_end(object_key)
+            self.saved_requests += 1
+            return True
+
+    def add(self, bucket_id: str, object_key: str) -> bool:
+        """Remember object_key; True when it was not in the index yet"""
+        with self._lock:
+            keys = self._buckets.setdefault(bucket_id, OrderedDict())
+            added = object_key not in keys
+            keys[object_key] = None
+            keys.move_to_end(object_key)
+            while len(keys) > self.max_size:
+                keys.popitem(last=False)
+            return added
+
+    def load(self, bucket_id: str, storage) -> None:
+        """Merge the persisted copy from session.storage once per process"""
+        if bucket_id in self._loaded:
+            return
+        self._loaded.add(bucket_id)
+        try:
+            data = storage.get(f"{INDEX_STORAGE_KEY}_{bucket_id}")
+            persisted = json.loads(data.decode()) if data else []
+        except Exception as e:
+            logger.warning(f"Failed to load persisted TOS object index: {e}")
+            return
+        with self._lock:
+            keys = self._buckets.setdefault(bucket_id, OrderedDict())
+            for object_key in persisted:
+                if object_key not in keys:
+                    keys[object_key] = None
+                    keys.move_to_end(object_key, last=False)
+
+    def persist(self, bucket_id: str, storage) -> None:
+        with self._lock:
+            recent = list(self._buckets.get(bucket_id, ()))[-MAX_PERSISTED_OBJECTS:]
+        try:
+            storage.set(f"{INDEX_STORAGE_KEY}_{bucket_id}", json.dumps(recent).encode())
+        except Exception as e:
+            logger.warning(f"Failed to persist TOS object index: {e}")
+
+
+known_objects = KnownObjectIndex()
+
+
+class TosObjectStore:
+    """Uploads content-addressed objects to the configured TOS bucket"""
+
+    def __init__(self, credentials: dict, storage=None):
+        self.credentials = credentials
+        self.bucket_name = credentials["VOLCENGINE_TOS_BUCKET_NAME"]
+        self.client = get_tos_client(credentials)
+        self.storage = storage
+        # 索引按 endpoint + 桶区分, 不包含密钥
+        self.bucket_id = credential_fingerprint(credentials["VOLCENGINE_TOS_ENDPOINT"], self.bucket_name)[:16]
+        if storage is not None:
+            known_objects.load(self.bucket_id, storage)
+
+    def url(self, object_key: str) -> str:
+        return f"https://{self.bucket_name}.{str(URL(self.credentials['VOLCENGINE_TOS_ENDPOINT']).host)}/{object_key}"
+
+    def ensure_object(self, object_key: str, content, size: int | None = None) -> None:
+        """Upload content under object_key unless the object is already in the bucket
+
+        content may be bytes or a seekable file object of the given size;
+        file objects larger than MULTIPART_THRESHOLD use a multipart upload.
+
+        Raises on TOS errors other than a missing object, like the previous
+        inline head_object/put_object sequence did.
+        """
+        if known_objects.contains(self.bucket_id, object_key):
+            logger.info("TOS object already known, skipping head_object [key=%s, saved_requests=%d]", object_key, known_objects.saved_requests)
+            return
+
+        from tos.exceptions import TosServerError
+
+        try:
+            logger.info("Checking TOS object existence [bucket=%s, key=%s]", self.bucket_name, object_key)
+            self.client.head_object(bucket=self.bucket_name, key=object_key)
+            logger.info(f"File {object_key} already exists in TOS bucket")
+        except TosServerError as e:
+            if e.status_code != 404:
+                logger.error(f"TOS check error: {e}")
+            # Upload if not exists
+            self._upload(object_key, content, size)
+
+        # 只有新增对象时才重写持久化的索引
+        if known_objects.add(self.bucket_id, object_key) and self.storage is not None:
+            known_objects.persist(self.bucket_id, self.storage)
+
+    def _upload(self, object_key: str, content, size: int | None) -> None:
+        if isinstance(content, (bytes, bytearray)) or size is None or size <= MULTIPART_THRESHOLD:
+            if hasattr(content, "seek"):
+                content.seek(0)
+            self.client.put_object(bucket=self.bucket_name, key=object_key, content=content)
+            return
+
+        from tos.models2 import UploadedPart
+
+        logger.info("Starting multipart upload [key=%s, size=%d]", object_key, size)
+        content.seek(0)
+        upload_id = self.client.create_multipart_upload(bucket=self.bucket_name, key=object_key).upload_id
+        try:
+            parts = []
+            part_number = 1
+            while True:
+                chunk = content.read(MULTIPART_PART_SIZE)
+                if not chunk:
+                    break
+                out = self.client.upload_part(bucket=self.bucket_name, key=object_key, upload_id=upload_id, part_number=part_number, content=chunk)
+                parts.append(UploadedPart(part_number, out.etag))
+                part_number += 1
+            self.client.complete_multipart_upload(bucket=self.bucket_name, key=object_key, upload_id=upload_id, parts=parts)
+        except Exception:
+            try:
+                self.client.abort_multipart_upload(bucket=self.bucket_name, key=object_key, upload_id=upload_id)
+            except Exception as e:
+                logger.warning(f"Failed to abort multipart upload: {e}")
+            raise
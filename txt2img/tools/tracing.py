@@ -0,0 +1,150 @@
+import contextvars
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# TXT2IMG_TRACE=jsonl|otel 开启耗时追踪; TXT2IMG_TRACE_FILE 指定输出文件, 否则写入日志
+TRACE_FORMAT = os.environ.get("TXT2IMG_TRACE", "").strip().lower()
+TRACE_FILE = os.environ.get("TXT2IMG_TRACE_FILE")
+TRACE_ENABLED = TRACE_FORMAT in {"jsonl", "otel"}
+
+_current_span: contextvars.ContextVar["Span | None"] = contextvars.ContextVar("txt2img_span", default=None)
+_export_lock = threading.Lock()
+
+
+class _NoopSpan:
+    """Returned when tracing is disabled so instrumented code pays almost nothing"""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def set_attribute(self, key: str, value) -> None:
+        pass
+
+    def end(self, error: BaseException | None = None) -> None:
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Span:
+    """A timed phase of a tool invocation, nested under the span that was active when it started"""
+
+    __slots__ = ("name", "attributes", "trace_id", "span_id", "parent_id", "start_ns", "end_ns", "error", "_token")
+
+    def __init__(self, name: str, attributes: dict):
+        parent = _current_span.get()
+        self.name = name
+        self.attributes = attributes
+        self.trace_id = parent.trace_id if parent else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent else None
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.error = None
+        self._token = _current_span.set(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # 调用方提前关闭生成器不算错误
+        self.end(None if isinstance(exc, GeneratorExit) else exc)
+        return False
+
+    def set_attribute(self, key: str, value) -> None:
+        self.attributes[key] = value
+
+    def end(self, error: BaseException | None = None) -> None:
+        if self.end_ns is not None:
+            return
+        self.end_ns = time.time_ns()
+        self.error = error
+        try:
+            _current_span.reset(self._token)
+        except ValueError:
+            # 生成器在另一个上下文中结束, 无法还原, 保留父级即可
+            pass
+        _export(self)
+
+
+def span(name: str, **attributes) -> "Span | _NoopSpan":
+    """Start a span; use as a context manager or call end() explicitly"""
+    if not TRACE_ENABLED:
+        return NOOP_SPAN
+    return Span(name, attributes)
+
+
+def traced_generator(name: str):
+    """Wrap a generator function (e.g. Tool._invoke) in a span covering its whole iteration"""
+
+    def decorator(func):
+        if not TRACE_ENABLED:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                yield from func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def _to_record(s: Span) -> dict:
+    if TRACE_FORMAT == "otel":
+        return {
+            "traceId": s.trace_id,
+            "spanId": s.span_id,
+            "parentSpanId": s.parent_id or "",
+            "name": s.name,
+            "kind": 1,
+            "startTimeUnixNano": str(s.start_ns),
+            "endTimeUnixNano": str(s.end_ns),
+            "attributes": [{"key": k, "value": _otel_value(v)} for k, v in s.attributes.items()],
+            "status": {"code": 2, "message": str(s.error)} if s.error else {"code": 1},
+        }
+    return {
+        "trace_id": s.trace_id,
+        "span_id": s.span_id,
+        "parent_id": s.parent_id,
+        "name": s.name,
+        "start_ns": s.start_ns,
+        "duration_ms": round((s.end_ns - s.start_ns) / 1e6, 3),
+        "attributes": s.attributes,
+        "error": str(s.error) if s.error else None,
+    }
+
+
+def _otel_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _export(s: Span) -> None:
+    try:
+        line = json.dumps(_to_record(s), ensure_ascii=False, default=str)
+        if TRACE_FILE:
+            with _export_lock, open(TRACE_FILE, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+        else:
+            logger.info("trace %s", line)
+    except Exception as e:
+        logger.warning(f"Failed to export span {s.name}: {e}")